@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Records the api responses ghrepo receives for a repository into a fixture the stub server can replay. The
+recorded calls are those of exercise: the commit listing, the GraphQL history, commitfiles of the most recent
+commits, the tree of HEAD & a diff. Replaying the same calls against the stub requests exactly the recorded urls.
+Only response bodies & Link headers are recorded (urls of the api written as '{api}'), never request headers or
+credentials.
+usage: python bench/record.py -r OWNER/NAME [-t TOKEN] [--api URL] [-n COMMITS] -o FIXTURE
+"""
+import argparse,datetime,json,os,sys,threading
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ghrepo.scheduler import RequestScheduler
+from ghrepo.session import GHSession
+from stub import fixturekey
+
+# fields a GraphQL history record shares with allcommits & commitfiles info
+_SHARED = ('hash','thash','date','time','message','parents')
+
+
+class RecordingScheduler(RequestScheduler):
+    """RequestScheduler keeping the status, Link header & body of each response from api, keyed by fixturekey"""
+    def __init__(self,api,**kwargs):
+        super().__init__(**kwargs)
+        self.api = api.rstrip('/')
+        self.graphql = self.api[:-3]+"/graphql" if self.api.endswith('/v3') else self.api+"/graphql"
+        self.responses = {}
+        self._record = threading.Lock()
+
+    def _relpath(self,url):
+        if url.startswith(self.graphql):
+            return "/graphql"+url[len(self.graphql):]
+        if url.startswith(self.api):
+            return url[len(self.api):]
+        return None
+
+    def request(self,method,url,stream=False,**kwargs):
+        r = super().request(method,url,stream,**kwargs)
+        path = self._relpath(url)
+        # streamed archives are not recorded, their bodies belong to the caller
+        if stream or path is None or r.status_code in (403,429) or r.status_code >= 500:
+            return r
+        headers = {}
+        if 'Link' in r.headers:
+            headers['Link'] = r.headers['Link'].replace(self.api,'{api}')
+        with self._record:
+            self.responses[fixturekey(method,path,kwargs.get('json'))] = {'status':r.status_code,'headers':headers,'body':r.text.replace(self.api,'{api}')}
+        return r
+
+
+def exercise(session,commits=20):
+    """
+    Runs the recorded calls on session, returns their results as a dict:
+    commits -> allcommits, history -> iter_history records,
+    files -> [(info,files),...] of the most recent commits, tree -> commit_tree of HEAD, diff -> diff over those commits
+    """
+    history = [*session.iter_history()]
+    listed = session.allcommits()
+    hashes = [c['hash'] for c in listed[:commits]]
+    return {
+        'commits':listed,
+        'history':history,
+        'files':[*session.iter_commitfiles(hashes)],
+        'tree':session.commit_tree('HEAD'),
+        'diff':session.diff(hashes[-1],hashes[0]) if len(hashes) > 1 else [],
+    }
+
+def check(results):
+    """Returns the mismatches between the GraphQL history, the commit listing & commitfiles info of results"""
+    errors = []
+    if len(results['history']) != len(results['commits']):
+        errors.append("{} history records, {} commits".format(len(results['history']),len(results['commits'])))
+    for h,c in zip(results['history'],results['commits']):
+        errors.extend("{} {}: history {!r}, commits {!r}".format(c['hash'][:8],k,h[k],c[k]) for k in _SHARED if h[k] != c[k])
+    history = {h['hash']:h for h in results['history']}
+    for info,files in results['files']:
+        h = history.get(info['hash'])
+        if h is None:
+            errors.append("{} missing from history".format(info['hash'][:8]))
+            continue
+        errors.extend("{} {}: history {!r}, commitfiles {!r}".format(info['hash'][:8],k,h[k],info[k]) for k in ('additions','deletions') if h[k] != info[k])
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record api responses into a stub server fixture')
+    parser.add_argument('-r','--repo',type=str,required=True,metavar='OWNER/NAME')
+    parser.add_argument('-u','--user',type=str)
+    parser.add_argument('-t','--token',type=str,help='Access token (defaults to $GITHUB_TOKEN)')
+    parser.add_argument('--api',type=str,default=GHSession.api,help='Base url of the api to record from')
+    parser.add_argument('-n','--commits',type=int,default=20,help='Number of recent commits to record commitfiles for')
+    parser.add_argument('-o','--output',type=str,required=True,metavar='FIXTURE')
+    args = parser.parse_args()
+    token = args.token or os.environ.get('GITHUB_TOKEN') or os.environ.get('GH_TOKEN')
+    scheduler = RecordingScheduler(args.api)
+    with GHSession(args.user,None,args.repo,scheduler=scheduler,token=token) as session:
+        session.api = session.web = args.api.rstrip('/')
+        results = exercise(session,args.commits)
+    scheduler.close()
+    for error in check(results):
+        print("Warning: {}".format(error),file=sys.stderr)
+    fixture = {
+        'repo':session.fullname,
+        'api':args.api,
+        'recorded':datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commits':args.commits,
+        'responses':dict(sorted(scheduler.responses.items())),
+    }
+    with open(args.output,'w') as f:
+        json.dump(fixture,f,indent=1)
+        f.write("\n")
+    print("{}: {} responses, {} commits".format(args.output,len(scheduler.responses),len(results['commits'])),file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks of ghrepo. Network benchmarks run against the stub server (bench/stub.py), started as a
+subprocess serving synthetic repositories sized by --scale & the recorded fixtures in bench/fixtures. Offline
+benchmarks time tree drawing, sorting, merging & formatting on generated files & commits.
+Each benchmark reports its best wall time over --runs, the api requests, connections & bytes the stub served during
+a run, the peak memory allocated during a run (traced separately, as tracing slows it down) and its throughput.
+Results are written as json with --json, --compare reports the change from a previous results file.
+usage: python bench/run.py [-k NAME ...] [--scale small|medium|large] [--latency MS] [-n RUNS] [--json FILE] [--compare FILE]
+"""
+import argparse,datetime,gc,glob,json,os,platform,random,shutil,subprocess,sys,tempfile,time,tracemalloc,zipfile
+import requests
+from functools import cmp_to_key
+from itertools import islice
+from urllib.request import Request,urlopen
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0,ROOT)
+
+from ghrepo.blobstore import BlobStore
+from ghrepo.cache import ObjectCache
+from ghrepo.index import CommitIndex
+from ghrepo.scheduler import RequestScheduler
+from ghrepo.session import GHSession,GHSessionBase
+from ghrepo.tree import CommitFile,ChangedCommitFile,sortfiles,itertree
+from ghrepo.util import compile_ls_format,compile_get_format,iso_epoch
+from record import exercise,check
+from stub import filepaths
+
+# synthetic repositories served by the stub ('name:key=value,...' specs) & the number of generated files or commits
+# of offline benchmarks. Trees of 100000+ entries are truncated, so medium & large trees are fetched piecewise
+SCALES = {
+    'small':{
+        'history':"commits=300,files=200",
+        'tree':"commits=5,files=20000,depth=3,fanout=10",
+        'get':"commits=5,files=500,blob_size=2048,export_subst=1",
+        'offline':20000,
+    },
+    'medium':{
+        'history':"commits=2000,files=1000",
+        'tree':"commits=5,files=150000,depth=3,fanout=12",
+        'get':"commits=5,files=2000,blob_size=4096,export_subst=1",
+        'offline':200000,
+    },
+    'large':{
+        'history':"commits=10000,files=5000",
+        'tree':"commits=5,files=1000000,depth=4,fanout=10",
+        'get':"commits=5,files=10000,blob_size=4096,export_subst=1",
+        'offline':1000000,
+    },
+}
+
+# ---- registry ---- #
+
+BENCHMARKS = {}
+
+def benchmark(unit,repo=None):
+    """
+    Registers a benchmark: a function of the Context returning a callable that runs it once & returns the number of
+    items (in unit) it processed. Work done before returning the callable is not timed.
+    repo -> the stub repository the benchmark requests from ('fixtures' for the recorded ones), None if offline
+    """
+    def register(fn):
+        BENCHMARKS[fn.__name__] = (fn,unit,repo)
+        return fn
+    return register
+
+
+class UnpooledScheduler(RequestScheduler):
+    """RequestScheduler closing the connection after every response, the transport of a request per connection"""
+    def __init__(self,workers=4,**kwargs):
+        super().__init__(workers,**kwargs)
+        self.http.headers['Connection'] = 'close'
+
+
+class Context():
+    """Shared state of a benchmark run: the stub server, generated data, sessions & a scratch directory"""
+    def __init__(self,url,scale,workers,tmp):
+        self.url = url
+        self.scale = scale
+        self.workers = workers
+        self.tmp = tmp
+        self.fixtures = {}
+        self._sessions = []
+        self._dirs = 0
+
+    def control(self,endpoint,body=None):
+        data = None if body is None else json.dumps(body).encode()
+        with urlopen(Request("{}/_stub/{}".format(self.url,endpoint),data,{'Content-Type':'application/json'})) as r:
+            return json.load(r)
+
+    def stats(self):
+        if self.url is None:
+            return {'requests':0,'connections':0,'bytes':0}
+        return self.control('stats')
+
+    def session(self,repo,**kwargs):
+        s = GHSession(None,None,repo if '/' in repo else "bench/"+repo,workers=self.workers,token='bench',**kwargs)
+        s.api = s.web = self.url
+        self._sessions.append(s)
+        return s
+
+    def heads(self,repo):
+        """Commit shas of a synthetic repository, newest first"""
+        return self.control('repos')["bench/"+repo]['commits']
+
+    def mkdtemp(self):
+        self._dirs += 1
+        return os.path.join(self.tmp,str(self._dirs))
+
+    def close(self):
+        for s in self._sessions:
+            s.close()
+            if not s._ownscheduler:
+                s.scheduler.close()
+
+    # ---- generated data ---- #
+
+    def paths(self):
+        if not hasattr(self,'_paths'):
+            depth = 4 if self.scale['offline'] > 200000 else 3
+            self._paths = [*filepaths(self.scale['offline'],depth,10)]
+            random.Random(0).shuffle(self._paths)
+        return self._paths
+
+    def files(self):
+        if not hasattr(self,'_files'):
+            self._files = sortfiles(CommitFile(p,"{:040x}".format(i)) for i,p in enumerate(self.paths()))
+        return self._files
+
+    def commits(self):
+        if not hasattr(self,'_commits'):
+            rng = random.Random(0)
+            self._commits = [{
+                'repo':'repo',
+                'hash':"{:040x}".format(rng.getrandbits(160)),
+                'date':time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(1500000000+i*600)),
+                'message':"Commit {}: update {}\n\nbody".format(i,p),
+                'additions':rng.randrange(500),
+                'deletions':rng.randrange(500),
+            } for i,p in enumerate(self.paths())]
+        return self._commits
+
+# ---- network benchmarks ---- #
+
+@benchmark('commits','history')
+def ls(ctx):
+    s = ctx.session('history')
+    return lambda:len(s.allcommits())
+
+@benchmark('commits','history')
+def ls_sync(ctx):
+    # an up to date cached history, revalidated by one conditional request
+    s = ctx.session('history',cache=ObjectCache(ctx.mkdtemp()))
+    s.allcommits()
+    return lambda:len(s.allcommits())
+
+@benchmark('commits','history')
+def ls_graphql(ctx):
+    s = ctx.session('history')
+    return lambda:sum(1 for _ in s.iter_history())
+
+@benchmark('commits','history')
+def cfile(ctx):
+    s = ctx.session('history')
+    hashes = ctx.heads('history')[:500]
+    return lambda:sum(1 for _ in s.iter_commitfiles(hashes))
+
+@benchmark('commits','history')
+def fetch_pooled(ctx):
+    # commitfiles over the keep-alive connections of the session's RequestScheduler, opened by the first run
+    s = ctx.session('history')
+    hashes = ctx.heads('history')[:200]
+    return lambda:sum(1 for _ in s.iter_commitfiles(hashes))
+
+@benchmark('commits','history')
+def fetch_unpooled(ctx):
+    # the same requests as fetch_pooled, each over a connection of its own
+    s = ctx.session('history',scheduler=UnpooledScheduler(ctx.workers))
+    hashes = ctx.heads('history')[:200]
+    return lambda:sum(1 for _ in s.iter_commitfiles(hashes))
+
+@benchmark('commits','history')
+def index(ctx):
+    s = ctx.session('history')
+    return lambda:CommitIndex(ctx.mkdtemp()).update(s)
+
+@benchmark('files','tree')
+def tree(ctx):
+    s = ctx.session('tree')
+    def run():
+        t = s.commit_tree('HEAD')
+        for line in t.itertree():
+            pass
+        return len(t.files)
+    return run
+
+@benchmark('files','tree')
+def tree_include(ctx):
+    # subtrees outside d1 are never fetched
+    s = ctx.session('tree')
+    return lambda:len(s.commit_tree('HEAD',include=['d1']).files)
+
+@benchmark('files','tree')
+def diff(ctx):
+    s = ctx.session('tree')
+    heads = ctx.heads('tree')
+    return lambda:len(s.diff(heads[-1],heads[0]))
+
+@benchmark('bytes','get')
+def get(ctx):
+    s = ctx.session('get')
+    head = ctx.heads('get')[0]
+    def run():
+        received = []
+        s.download_commit(head,ctx.mkdtemp(),received.append)
+        return sum(received)
+    return run
+
+@benchmark('bytes','get')
+def get_zip(ctx):
+    # the download get replaced: the web zip written to disk in 1 KiB chunks, then extracted & the root renamed
+    url = "{}/bench/get/archive/{}.zip".format(ctx.url,ctx.heads('get')[0])
+    def run():
+        dirpath = ctx.mkdtemp()
+        os.makedirs(dirpath)
+        zippath = os.path.join(dirpath,'archive.zip')
+        received = 0
+        with requests.get(url,stream=True) as r, open(zippath,'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024):
+                f.write(chunk)
+                received += len(chunk)
+        with zipfile.ZipFile(zippath) as z:
+            root = z.namelist()[0].split('/')[0]
+            z.extractall(dirpath)
+        os.remove(zippath)
+        os.rename(os.path.join(dirpath,root),dirpath+".out")
+        return received
+    return run
+
+@benchmark('files','get')
+def get_dedup(ctx):
+    # consecutive snapshots exported into one blob store, seeded from the first tarball, unchanged blobs are only fetched once
+    s = ctx.session('get')
+    heads = ctx.heads('get')
+    trees = [(s.commitinfo(h)['thash'],h) for h in heads]
+    def run():
+        store = BlobStore(ctx.mkdtemp())
+        files = 0
+        for thash,chash in trees:
+            path = ctx.mkdtemp()
+            s.export_commit(thash,path,store,chash=chash)
+            files += sum(len(f) for _,_,f in os.walk(path))
+        return files
+    return run
+
+@benchmark('commits','fixtures')
+def replay(ctx):
+    # recorded fixtures, checking the GraphQL history against the commit listing & commitfiles
+    sessions = [(ctx.session(repo),n) for repo,n in ctx.fixtures.items()]
+    def run():
+        commits = 0
+        for s,n in sessions:
+            results = exercise(s,n)
+            errors = check(results)
+            if len(errors):
+                raise AssertionError("{}: {}".format(s.fullname,"; ".join(errors)))
+            commits += len(results['commits'])
+        return commits
+    return run
+
+# ---- offline benchmarks ---- #
+
+def _cmpsorted(files):
+    """files sorted by the pairwise CommitFile comparison sortfiles replaced"""
+    return sorted(files,key=cmp_to_key(lambda a,b:CommitFile._cmp_(a.path,b.path)))
+
+@benchmark('files')
+def sort(ctx):
+    files = [CommitFile(p,'') for p in ctx.paths()]
+    # sortfiles must order every file exactly as the CommitFile comparison does
+    if [f.path for f in sortfiles(files)] != [f.path for f in _cmpsorted(files)]:
+        raise AssertionError("sortfiles order differs from CommitFile._cmp_")
+    return lambda:len(sortfiles(files))
+
+@benchmark('files')
+def sort_cmp(ctx):
+    # the same files sorted by CommitFile._cmp_, as before sortfiles
+    files = [CommitFile(p,'') for p in ctx.paths()]
+    return lambda:len(_cmpsorted(files))
+
+def _maketree(paths,lvl=0):
+    """The recursive tree drawing itertree replaced, kept as the reference for its output"""
+    i,n = 0,len(paths)
+    while i < n and len(paths[i])-lvl == 1:
+        i=i+1
+    if i == n:
+        return ["├── {}".format(f.treestr) for f in paths[:-1]]+["└── {}".format(paths[-1].treestr)]
+    ftree = ["├── {}".format(f.treestr) for f in paths[:i]]
+    groups = [i]+[x for x in range(i+1,n) if paths[x].path[lvl]!=paths[x-1].path[lvl]]
+    for i1,i2 in zip(groups,groups[1:]):
+        ftree += ["├── {}".format(paths[i1].path[lvl])]+["│\xa0\xa0 {}".format(f) for f in _maketree(paths[i1:i2],lvl+1)]
+    i = groups[-1]
+    return ftree + ["└── {}".format(paths[i].path[lvl])]+[" \xa0\xa0 {}".format(f) for f in _maketree(paths[i:],lvl+1)]
+
+@benchmark('lines')
+def maketree(ctx):
+    files = ctx.files()
+    # itertree must draw exactly the lines of the recursive maketree, checked with files added beside directories at
+    # every level, as the generated paths all share one depth
+    paths = ctx.paths()
+    mixed = sortfiles(CommitFile(p,'') for p in paths+["/".join(p.split('/')[:i%4]+["m{}.txt".format(i)]) for i,p in enumerate(paths[::97])])
+    for check in (files,mixed):
+        if [*itertree(check)] != _maketree(check):
+            raise AssertionError("itertree lines differ from the recursive maketree")
+    return lambda:sum(1 for _ in itertree(files))
+
+@benchmark('files')
+def merge_filetree(ctx):
+    files = ctx.files()
+    changed = sortfiles(ChangedCommitFile({'filename':str(f),'sha':f.sha,'status':'modified','additions':1,'deletions':1,'changes':2}) for f in islice(files,0,None,max(len(files)//300,1)))
+    return lambda:sum(1 for _ in GHSessionBase._merge_filetree(changed,files))
+
+@benchmark('commits')
+def format_ls(ctx):
+    commits = ctx.commits()
+    fmt = compile_ls_format("%h %d %t %m (+%A -%D)")
+    return lambda:sum(1 for c in commits if fmt(c))
+
+@benchmark('commits')
+def format_get(ctx):
+    commits = ctx.commits()
+    fmt = compile_get_format("%d_%t_%h_%m")
+    return lambda:sum(1 for c in commits if fmt(c))
+
+@benchmark('commits')
+def parse_time(ctx):
+    commits = ctx.commits()
+    return lambda:sum(1 for c in commits if iso_epoch(c['date']))
+
+@benchmark('files')
+def commitfile_memory(ctx):
+    paths = ctx.paths()
+    return lambda:len([CommitFile(p,'0'*40) for p in paths])
+
+# ---- harness ---- #
+
+def measure(ctx,fn,unit,runs,memory):
+    run = fn(ctx)
+    best = None
+    for _ in range(runs):
+        gc.collect()
+        before = ctx.stats()
+        t0 = time.perf_counter()
+        items = run()
+        wall = time.perf_counter()-t0
+        after = ctx.stats()
+        best = wall if best is None or wall < best else best
+    result = {
+        'wall_s':best,
+        'requests':after['requests']-before['requests'],
+        'connections':after['connections']-before['connections'],
+        'received_bytes':after['bytes']-before['bytes'],
+        'peak_mib':None,
+        'items':items,
+        'unit':unit,
+        'throughput':items/best if best > 0 else None,
+    }
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            result['peak_mib'] = tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+    return result
+
+def start_stub(repos,fixtures,args):
+    """Starts the stub server serving repos ({name:spec}) & fixtures, returns (process,url)"""
+    cmd = [sys.executable,os.path.join(BENCH,'stub.py'),'--latency',str(args.latency),'--ratelimit',str(args.ratelimit),'--error-rate',str(args.error_rate)]
+    for name,spec in repos.items():
+        cmd.extend(['--repo',"{}:{}".format(name,spec)])
+    for path in fixtures:
+        cmd.extend(['--replay',path])
+    proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,text=True)
+    url = proc.stdout.readline().strip()
+    if not url:
+        proc.wait()
+        raise RuntimeError("stub server exited with status {}".format(proc.returncode))
+    return proc,url
+
+def _gitrev():
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],cwd=ROOT,capture_output=True,text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def _fmt(v,spec):
+    return "-" if v is None else spec.format(v)
+
+def report(results,previous=None):
+    header = "{:<18} {:>9} {:>9} {:>11} {:>10} {:>9} {:>18}".format('benchmark','wall','requests','connections','received','peak','throughput')
+    lines = [header+("  {:>8} {:>9}".format('vs wall','requests') if previous else "")]
+    for name,r in results.items():
+        line = "{:<18} {:>8.3f}s {:>9} {:>11} {:>9.1f}M {:>9} {:>18}".format(
+            name,r['wall_s'],r['requests'],r.get('connections',0),r['received_bytes']/2**20,_fmt(r['peak_mib'],"{:.1f}M"),
+            _fmt(r['throughput'],"{:,.0f} "+r['unit']+"/s"))
+        old = (previous or {}).get(name)
+        if old is not None:
+            line += "  {:>7.2f}x {:>+9}".format(r['wall_s']/old['wall_s'] if old['wall_s'] else float('nan'),r['requests']-old['requests'])
+        lines.append(line)
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='ghrepo offline benchmarks')
+    parser.add_argument('-k',type=str,action='append',metavar='NAME',help='Run only benchmarks whose name contains NAME (repeatable)')
+    parser.add_argument('-l','--list',action='store_true',help='List the benchmarks & exit')
+    parser.add_argument('--scale',choices=[*SCALES],default='small',help='Size of the synthetic repositories & generated data')
+    parser.add_argument('-n','--runs',type=int,default=3,help='Runs per benchmark, the best wall time is reported')
+    parser.add_argument('-w','--workers',type=int,default=4,help='Session workers (concurrent requests)')
+    parser.add_argument('--latency',type=float,default=0,metavar='MS',help='Latency the stub adds to every response')
+    parser.add_argument('--ratelimit',type=int,default=10**9,metavar='N',help='Stub rate limit budget per hour')
+    parser.add_argument('--error-rate',type=float,default=0,metavar='P',help='Fraction of requests the stub answers with a 502')
+    parser.add_argument('--fixtures',type=str,default=os.path.join(BENCH,'fixtures'),metavar='DIR',help='Directory of recorded fixtures to replay')
+    parser.add_argument('--no-memory',action='store_true',help='Skip the traced peak memory run')
+    parser.add_argument('--json',type=str,metavar='FILE',help="Write results as json to FILE ('-' for stdout)")
+    parser.add_argument('--compare',type=str,metavar='FILE',help='Previous results file to compare against')
+    parser.add_argument('--max-slowdown',type=float,metavar='RATIO',help='Exit with status 1 if a wall time exceeds RATIO times that of --compare')
+    args = parser.parse_args()
+    names = [n for n in BENCHMARKS if args.k is None or any(k in n for k in args.k)]
+    if args.list:
+        for n in names:
+            fn,unit,repo = BENCHMARKS[n]
+            print("{:<18} {:<8} {}".format(n,repo or 'offline',unit))
+        return
+    if args.max_slowdown is not None and args.compare is None:
+        parser.error("--max-slowdown requires --compare")
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    scale = SCALES[args.scale]
+    repos = {BENCHMARKS[n][2] for n in names}
+    fixtures = sorted(glob.glob(os.path.join(args.fixtures,'*.json'))) if 'fixtures' in repos else []
+    specs = {r:scale[r] for r in repos if r in scale}
+    proc,url = start_stub(specs,fixtures,args) if len(specs) or len(fixtures) else (None,None)
+    tmp = tempfile.mkdtemp(prefix='ghrepo-bench-')
+    ctx = Context(url,scale,args.workers,tmp)
+    for path in fixtures:
+        with open(path) as f:
+            fixture = json.load(f)
+        ctx.fixtures[fixture['repo']] = fixture['commits']
+    results = {}
+    try:
+        for n in names:
+            fn,unit,repo = BENCHMARKS[n]
+            if repo == 'fixtures' and not len(fixtures):
+                continue
+            print("running {}".format(n),file=sys.stderr,flush=True)
+            results[n] = measure(ctx,fn,unit,args.runs,not args.no_memory)
+    finally:
+        ctx.close()
+        shutil.rmtree(tmp,ignore_errors=True)
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    print(report(results,previous),file=sys.stderr)
+    output = {
+        'meta':{
+            'date':datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'commit':_gitrev(),
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'scale':args.scale,
+            'specs':specs,
+            'runs':args.runs,
+            'workers':args.workers,
+            'latency_ms':args.latency,
+        },
+        'results':results,
+    }
+    if args.json is not None:
+        text = json.dumps(output,indent=2)
+        if args.json == '-':
+            print(text)
+        else:
+            with open(args.json,'w') as f:
+                f.write(text+"\n")
+    if args.max_slowdown is not None:
+        slower = [n for n,r in results.items() if n in previous and previous[n]['wall_s'] and r['wall_s']/previous[n]['wall_s'] > args.max_slowdown]
+        if len(slower):
+            print("slower than {}x: {}".format(args.max_slowdown,", ".join(slower)),file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Startup benchmark of the ghrepo cli, guarding against import regressions. Measures the cumulative import time
+of ghrepo.__main__ with python -X importtime, and the wall time of invocations that exit before any request.
+Exits with status 1 if a heavy module is imported at startup, or the import time exceeds --max-import-ms.
+usage: python bench/startup.py [-n RUNS] [--max-import-ms MS] [--json FILE]
+"""
+import argparse,json,os,subprocess,sys,time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules only the subcommands that use them may import
+HEAVY = ('requests','urllib3','aiohttp','msgpack','sqlite3','tarfile','concurrent.futures','ghrepo.session')
+
+# invocations that exit before a session is created
+INVOCATIONS = {
+    'help':['--help'],
+    'ls_help':['ls','--help'],
+    'bad_format':['ls','-r','o/r','-f','%Q'],
+}
+
+def _run(args,env):
+    return subprocess.run([sys.executable,*args],cwd=ROOT,env=env,capture_output=True,text=True)
+
+def importtime(module,env):
+    """Returns the cumulative import time (microseconds) of module in a fresh interpreter"""
+    r = _run(['-X','importtime','-c','import '+module],env)
+    for line in reversed(r.stderr.splitlines()):
+        fields = line.partition(':')[2].split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise RuntimeError("No import time reported for {}:\n{}".format(module,r.stderr))
+
+def loaded(module,env):
+    """Heavy modules present in sys.modules after importing module"""
+    r = _run(['-c','import sys,{};print(" ".join(sys.modules))'.format(module)],env)
+    modules = set(r.stdout.split())
+    return [m for m in HEAVY if m in modules]
+
+def walltime(args,env,runs):
+    """Best wall time (seconds) of running the interpreter with args"""
+    best = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        _run(args,env)
+        t = time.perf_counter()-t0
+        best = t if best is None or t < best else best
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='ghrepo cli startup benchmark')
+    parser.add_argument('-n','--runs',type=int,default=10,help='Runs per measurement, the best is reported')
+    parser.add_argument('--max-import-ms',type=float,metavar='MS',help='Fail if importing ghrepo.__main__ takes longer')
+    parser.add_argument('--json',type=str,metavar='FILE',help="Write results as json to FILE ('-' for stdout)")
+    args = parser.parse_args()
+    env = {**os.environ,'PYTHONPATH':os.pathsep.join([ROOT,os.environ.get('PYTHONPATH','')])}
+    results = {
+        'python':sys.version.split()[0],
+        'import_ms':min(importtime('ghrepo.__main__',env) for _ in range(args.runs))/1000,
+        'heavy_imports':loaded('ghrepo.__main__',env),
+        'interpreter_ms':walltime(['-c','pass'],env,args.runs)*1000,
+    }
+    for name,cli in INVOCATIONS.items():
+        results[name+'_ms'] = walltime(['-m','ghrepo',*cli],env,args.runs)*1000
+    for k,v in results.items():
+        print("{:<16} {}".format(k,"{:.1f}".format(v) if type(v) == float else v),file=sys.stderr)
+    if args.json is not None:
+        text = json.dumps(results,indent=2)
+        if args.json == '-':
+            print(text)
+        else:
+            with open(args.json,'w') as f:
+                f.write(text+"\n")
+    failed = len(results['heavy_imports']) > 0 or (args.max_import_ms is not None and results['import_ms'] > args.max_import_ms)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
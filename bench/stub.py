@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the parts of the Github api ghrepo uses, serving deterministic synthetic repositories and
+replaying recorded fixtures. Covers paginated commit listings (Link headers), git commits, commits with their
+changed files, plain & recursive trees (truncated past a number of entries as the real api does), blobs, tarball
+& zip archives and the GraphQL history query. Every response carries rate limit headers & an ETag, and latency,
+5xx errors & secondary rate limits can be injected.
+usage: python bench/stub.py [--port PORT] [--repo SPEC ...] [--replay FIXTURE ...] [--latency MS] [--truncate N]
+"""
+import argparse,base64,hashlib,io,json,random,sys,tarfile,threading,time,zipfile
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from urllib.parse import urlparse,parse_qs,urlencode
+
+EXTENSIONS = ('py','md','txt','json','c','h','js','yml')
+
+# paths of the control endpoints, which are not counted as api requests
+CONTROL = '/_stub/'
+
+def _gitsha(kind,data):
+    return hashlib.sha1(b"%s %d\0"%(kind,len(data))+data).hexdigest()
+
+def _isodate(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(t))
+
+def blobdata(path,version,size):
+    """Deterministic content of a file version: a header line & hex digits, compressing about as well as source"""
+    line = "{} v{}\n".format(path,version).encode()
+    return (line+hashlib.shake_128(line).hexdigest(max(size//2,1)).encode())[:size]
+
+def filepaths(files,depth=3,fanout=10):
+    """Paths of files spread evenly over fanout**depth nested directories, in the order they are created"""
+    leaves = fanout**depth
+    for i in range(files):
+        leaf,dirs = i%leaves,[]
+        for _ in range(depth):
+            leaf,d = divmod(leaf,fanout)
+            dirs.append("d{}".format(d))
+        yield "/".join(dirs+["f{}.{}".format(i,EXTENSIONS[i%len(EXTENSIONS)])])
+
+# ---- synthetic repositories ---- #
+
+class SyntheticRepo():
+    """
+    Deterministic synthetic repository. The first commit adds files spread over fanout**depth directories (plus a
+    README & an executable script), each following commit modifies changes of them & renames one every rename_every
+    commits. Unchanged subtrees are shared between commits, so tree shas compare the way git's do.
+    export_subst -> mark README.md export-subst in a .gitattributes, so archives hold it with its '$Format:%H$'
+        placeholder expanded & differing from its blob, as git archive does
+    """
+    # the commits api lists at most this many changed files per commit
+    maxfiles = 300
+
+    def __init__(self,owner='bench',name='repo',commits=100,files=1000,depth=3,fanout=10,changes=3,blob_size=256,rename_every=10,export_subst=0,seed=0,start=1500000000):
+        self.owner,self.name = owner,name
+        self.blob_size = blob_size
+        self.subst = {'README.md'} if export_subst else set()
+        self.trees = {}      # tree sha -> [(name,type,sha,mode),...] sorted by name
+        self.blobs = {}      # blob sha -> (path,version)
+        self.commits = []    # newest first
+        self.refs = {}       # commit sha (or 'HEAD') -> commit
+        self._dirs = {'':{}} # directory path -> {name:(type,sha,mode)} of the working tree
+        self._root = None
+        self._archives = OrderedDict()
+        rng = random.Random(seed)
+        paths = [*filepaths(files,depth,fanout),'README.md','bin/run.sh']+(['.gitattributes'] if export_subst else [])
+        versions = [0]*len(paths)
+        dirty = set()
+        changed = [self._setfile(p,0,'100755' if p.endswith('.sh') else '100644',dirty) for p in paths]
+        parent = None
+        for n in range(max(commits,1)):
+            if n > 0:
+                changed = []
+                for i in rng.sample(range(len(paths)),min(changes,len(paths))):
+                    versions[i] += 1
+                    record = self._setfile(paths[i],versions[i],'100644',dirty)
+                    if rename_every and n%rename_every == 0 and not len(changed):
+                        d,_,f = paths[i].rpartition('/')
+                        record = self._rename(paths[i],"{}{}r{}_{}".format(d,'/' if d else '',n,f),dirty)
+                        paths[i] = record['filename']
+                    changed.append(record)
+            tree = self._rebuild(dirty)
+            dirty.clear()
+            date = _isodate(start+n*3600)
+            message = "Commit {}\n\nChanges {} files".format(n,len(changed))
+            sha = _gitsha(b'commit',"tree {}\nparent {}\n{}\n{}".format(tree,parent,date,message).encode())
+            commit = {
+                'sha':sha,'tree':tree,'date':date,'message':message,'parents':[parent] if parent else [],
+                'author':"dev{}".format(n%7),'email':"dev{}@example.com".format(n%7),
+                'additions':sum(c['additions'] for c in changed),'deletions':sum(c['deletions'] for c in changed),
+                # the first commit touches every path, so it is never excluded by a path filter
+                'paths':None if n == 0 else {c['filename'] for c in changed},
+                'files':sorted(changed,key=lambda c:c['filename'])[:self.maxfiles],
+            }
+            self.commits.insert(0,commit)
+            self.refs[sha] = commit
+            parent = sha
+        self.refs['HEAD'] = self.commits[0]
+
+    @property
+    def fullname(self):
+        return "{}/{}".format(self.owner,self.name)
+
+    def content(self,sha):
+        return self._data(*self.blobs[sha])
+
+    def _data(self,path,version):
+        if path == '.gitattributes':
+            return "".join("{} export-subst\n".format(p) for p in sorted(self.subst)).encode()
+        data = blobdata(path,version,self.blob_size)
+        return b"$Format:%H$\n"+data if path in self.subst else data
+
+    def _archived(self,sha,commit):
+        """Content of a blob in an archive of commit, export-subst placeholders expanded"""
+        data = self.content(sha)
+        return data.replace(b"$Format:%H$",commit['sha'].encode()) if self.blobs[sha][0] in self.subst else data
+
+    def _setfile(self,path,version,mode,dirty):
+        sha = _gitsha(b'blob',self._data(path,version))
+        self.blobs[sha] = (path,version)
+        d,_,name = path.rpartition('/')
+        self._mkdirs(d,dirty)
+        self._dirs[d][name] = ('blob',sha,mode)
+        dirty.add(d)
+        if version == 0:
+            return {'filename':path,'sha':sha,'status':'added','additions':1,'deletions':0,'changes':1}
+        return {'filename':path,'sha':sha,'status':'modified','additions':1,'deletions':1,'changes':2}
+
+    def _rename(self,path,topath,dirty):
+        d,_,name = path.rpartition('/')
+        entry = self._dirs[d].pop(name)
+        self._dirs[d][topath.rpartition('/')[2]] = entry
+        return {'filename':topath,'sha':entry[1],'status':'renamed','previous_filename':path,'additions':1,'deletions':1,'changes':2}
+
+    def _mkdirs(self,d,dirty):
+        if d in self._dirs:
+            return
+        parent,_,name = d.rpartition('/')
+        self._mkdirs(parent,dirty)
+        self._dirs[d] = {}
+        self._dirs[parent][name] = ('tree',None,'040000')
+        dirty.add(parent)
+
+    def _rebuild(self,dirty):
+        """Recomputes the trees of dirty directories & their ancestors deepest first, returns the root tree sha"""
+        for d in [*dirty]:
+            while d:
+                d = d.rpartition('/')[0]
+                dirty.add(d)
+        for d in sorted(dirty,key=lambda d:-d.count('/')-(d != '')):
+            entries = [(name,*e) for name,e in sorted(self._dirs[d].items())]
+            sha = _gitsha(b'tree',"\n".join("{} {} {} {}".format(*e) for e in entries).encode())
+            self.trees[sha] = entries
+            if d:
+                parent,_,name = d.rpartition('/')
+                self._dirs[parent][name] = ('tree',sha,'040000')
+            else:
+                self._root = sha
+        return self._root
+
+    def walk(self,tsha,prefix=''):
+        """Yields (path,type,sha,mode) for every entry beneath a tree, in the order of a recursive listing"""
+        for name,kind,sha,mode in self.trees[tsha]:
+            yield prefix+name,kind,sha,mode
+            if kind == 'tree':
+                yield from self.walk(sha,prefix+name+'/')
+
+    def history(self,since=None,until=None,path=None,author=None):
+        """Commits newest first, filtered as the commits api filters them"""
+        commits = self.commits
+        if since: commits = [c for c in commits if c['date'] >= since]
+        if until: commits = [c for c in commits if c['date'] <= until]
+        if author: commits = [c for c in commits if author in (c['author'],c['email'])]
+        if path:
+            path = path.strip('/')
+            commits = [c for c in commits if c['paths'] is None or any(p == path or p.startswith(path+'/') for p in c['paths'])]
+        return commits
+
+    def archive(self,ref,kind):
+        """Gzipped tarball or zip archive of a commit's tree, the last few built are kept"""
+        commit = self.refs[ref]
+        key = (commit['sha'],kind)
+        if key in self._archives:
+            self._archives.move_to_end(key)
+            return self._archives[key]
+        root = "{}-{}-{}".format(self.owner,self.name,commit['sha'][:7])
+        buf = io.BytesIO()
+        files = [(p,sha,mode) for p,kind_,sha,mode in self.walk(commit['tree']) if kind_ == 'blob']
+        if kind == 'zip':
+            with zipfile.ZipFile(buf,'w',zipfile.ZIP_DEFLATED) as z:
+                for p,sha,mode in files:
+                    info = zipfile.ZipInfo("{}/{}".format(root,p),time.strptime(commit['date'],'%Y-%m-%dT%H:%M:%SZ')[:6])
+                    info.external_attr = (0o100755 if mode == '100755' else 0o100644)<<16
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    z.writestr(info,self._archived(sha,commit))
+        else:
+            with tarfile.open(fileobj=buf,mode='w:gz',compresslevel=6) as tar:
+                info = tarfile.TarInfo(root)
+                info.type,info.mode = tarfile.DIRTYPE,0o755
+                tar.addfile(info)
+                for p,sha,mode in files:
+                    data = self._archived(sha,commit)
+                    info = tarfile.TarInfo("{}/{}".format(root,p))
+                    info.size,info.mode = len(data),0o755 if mode == '100755' else 0o644
+                    tar.addfile(info,io.BytesIO(data))
+        self._archives[key] = buf.getvalue()
+        while len(self._archives) > 4:
+            self._archives.popitem(last=False)
+        return self._archives[key]
+
+    @classmethod
+    def fromspec(cls,spec):
+        """Parses a 'name:key=value,...' repository spec, eg 'history:commits=2000,files=200'"""
+        name,_,params = spec.partition(':')
+        kwargs = {}
+        for kv in filter(None,params.split(',')):
+            k,_,v = kv.partition('=')
+            kwargs[k.strip()] = v.strip() if k.strip() == 'owner' else int(v)
+        owner = kwargs.pop('owner','bench')
+        return cls(owner,name,**kwargs)
+
+# ---- recorded fixtures ---- #
+
+def fixturekey(method,path,body=None):
+    """
+    Key of a recorded request: the method, the path with its query parameters sorted, and for a POST the
+    canonical json of its body
+    """
+    u = urlparse(path)
+    query = urlencode(sorted(parse_qs(u.query).items()),doseq=True)
+    key = "{} {}{}".format(method,u.path,"?"+query if query else "")
+    if body is not None:
+        key = "{} {}".format(key,json.dumps(body,sort_keys=True,separators=(',',':')))
+    return key
+
+class Fixtures():
+    """
+    Recorded responses, as written by bench/record.py: {'responses':{key:{'status','headers','body'}}} where
+    '{api}' in bodies & header values stands for the base url of the api the responses were recorded from
+    """
+    def __init__(self,paths=()):
+        self.responses = {}
+        for path in paths:
+            with open(path) as f:
+                self.responses.update(json.load(f)['responses'])
+
+    def get(self,key):
+        return self.responses.get(key)
+
+# ---- server ---- #
+
+class StubState():
+    """Configuration & request counters shared by every handler thread"""
+    def __init__(self,repos=(),fixtures=None,latency=0.0,truncate=100000,ratelimit=5000,window=3600,error_rate=0.0,throttle_rate=0.0,seed=0):
+        self.repos = {r.fullname:r for r in repos}
+        self.fixtures = fixtures or Fixtures()
+        self.latency = latency
+        self.truncate = truncate
+        self.ratelimit = ratelimit
+        self.window = window
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.inject = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.connections = 0
+            self.bytes = 0
+            self.errors = 0
+            self.endpoints = {}
+            self._used = 0
+            self._windowstart = time.time()
+
+    def config(self,**kwargs):
+        with self._lock:
+            for k,v in kwargs.items():
+                if k == 'inject':
+                    self.inject.extend(v)
+                elif k in ('latency','truncate','ratelimit','window','error_rate','throttle_rate'):
+                    setattr(self,k,v)
+                else:
+                    raise KeyError(k)
+
+    def stats(self):
+        with self._lock:
+            return {'requests':self.requests,'connections':self.connections,'bytes':self.bytes,'errors':self.errors,'endpoints':dict(self.endpoints)}
+
+    def count(self,endpoint,connection=False):
+        """
+        Counts a request against the rate limit budget, and a connection if it is the first request over one.
+        Returns (ratelimit headers, injected response or None), where an injected response is (status,headers,body)
+        """
+        with self._lock:
+            now = time.time()
+            if now >= self._windowstart+self.window:
+                self._windowstart,self._used = now,0
+            self.requests += 1
+            self.connections += connection
+            self.endpoints[endpoint] = self.endpoints.get(endpoint,0)+1
+            reset = int(self._windowstart+self.window)
+            exhausted = self._used >= self.ratelimit
+            self._used = min(self._used+1,self.ratelimit)
+            headers = {
+                'X-RateLimit-Limit':str(self.ratelimit),
+                'X-RateLimit-Remaining':str(self.ratelimit-self._used),
+                'X-RateLimit-Used':str(self._used),
+                'X-RateLimit-Reset':str(reset),
+                'X-RateLimit-Resource':'graphql' if endpoint == 'graphql' else 'core',
+            }
+            if len(self.inject):
+                self.errors += 1
+                return headers,self.inject.pop(0)
+            if exhausted:
+                self.errors += 1
+                return headers,(403,{},{'message':"API rate limit exceeded for user."})
+            roll = self._rng.random()
+            if roll < self.error_rate:
+                self.errors += 1
+                return headers,(502,{},{'message':"Server Error"})
+            if roll < self.error_rate+self.throttle_rate:
+                self.errors += 1
+                return headers,(403,{'Retry-After':'1'},{'message':"You have exceeded a secondary rate limit."})
+            return headers,None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers & body are written separately, Nagle's algorithm would hold the body back for a delayed ack
+    disable_nagle_algorithm = True
+    # set on the subclass made by serve
+    state = None
+
+    def setup(self):
+        # called once per accepted connection, which is counted with its first request (control requests aside)
+        super().setup()
+        self.counted = False
+
+    def log_message(self,*args):
+        pass
+
+    @property
+    def base(self):
+        return "http://{}:{}".format(*self.server.server_address[:2])
+
+    def _send(self,status,body,headers=None,ctype='application/json; charset=utf-8'):
+        if isinstance(body,(dict,list)):
+            body = json.dumps(body,separators=(',',':')).encode()
+        headers = headers or {}
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status,body = 304,b''
+        self.send_response(status)
+        if status != 304:
+            self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        self.send_header('ETag',etag)
+        for k,v in headers.items():
+            self.send_header(k,v)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.state._lock:
+            self.state.bytes += len(body)
+
+    def _notfound(self,headers=None):
+        self._send(404,{'message':"Not Found",'documentation_url':"https://docs.github.com/rest"},headers)
+
+    def _control(self,path):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        if path == CONTROL+'stats':
+            return self._send(200,self.state.stats())
+        if path == CONTROL+'reset':
+            self.state.reset()
+            return self._send(200,self.state.stats())
+        if path == CONTROL+'config':
+            try:
+                self.state.config(**body)
+            except KeyError as e:
+                return self._send(400,{'message':"Unknown setting {}".format(e)})
+            return self._send(200,{})
+        if path == CONTROL+'repos':
+            return self._send(200,{name:{'head':r.commits[0]['sha'],'commits':[c['sha'] for c in r.commits]} for name,r in self.state.repos.items()})
+        self._notfound()
+
+    def _begin(self,endpoint):
+        """Counts the request & applies latency, returns the rate limit headers or None if an injected response was sent"""
+        headers,injected = self.state.count(endpoint,not self.counted)
+        self.counted = True
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if injected is not None:
+            status,extra,body = injected
+            self._send(status,body,{**headers,**extra})
+            return None
+        return headers
+
+    def _replay(self,key,headers):
+        recorded = self.state.fixtures.get(key)
+        if recorded is None:
+            return False
+        body = recorded['body'].replace('{api}',self.base).encode()
+        rheaders = {k:v.replace('{api}',self.base) for k,v in recorded.get('headers',{}).items()}
+        self._send(recorded['status'],body,{**headers,**rheaders})
+        return True
+
+    def do_GET(self):
+        u = urlparse(self.path)
+        if u.path.startswith(CONTROL):
+            return self._control(u.path)
+        parts = u.path.strip('/').split('/')
+        repo = self.state.repos.get('/'.join(parts[1:3])) if parts[0] == 'repos' else self.state.repos.get('/'.join(parts[:2]))
+        rest = parts[3:] if parts[0] == 'repos' else parts[2:]
+        endpoint = rest[:2] if rest[:1] == ['git'] else rest[:1]
+        headers = self._begin('/'.join(endpoint+([':ref'] if len(rest) > len(endpoint) else [])) or u.path)
+        if headers is None:
+            return
+        if repo is None:
+            if not self._replay(fixturekey('GET',self.path),headers):
+                self._notfound(headers)
+            return
+        query = {k:v[0] for k,v in parse_qs(u.query).items()}
+        try:
+            if parts[0] != 'repos':
+                # web archive urls: /{owner}/{repo}/archive/{ref}.zip|.tar.gz
+                if rest[:1] == ['archive'] and len(rest) == 2:
+                    if rest[1].endswith('.zip'):
+                        return self._send(200,repo.archive(rest[1][:-4],'zip'),headers,'application/zip')
+                    if rest[1].endswith('.tar.gz'):
+                        return self._send(200,repo.archive(rest[1][:-7],'tar'),headers,'application/x-gzip')
+                return self._notfound(headers)
+            if rest == ['commits']:
+                return self._commits(repo,u.path,query,headers)
+            if rest[:2] == ['git','commits'] and len(rest) == 3:
+                return self._send(200,self._gitcommitjson(repo,repo.refs[rest[2]]),headers)
+            if rest[:1] == ['commits'] and len(rest) == 2:
+                return self._send(200,self._commitjson(repo,repo.refs[rest[1]]),headers)
+            if rest[:2] == ['git','trees'] and len(rest) == 3:
+                return self._send(200,self._treejson(repo,rest[2],query.get('recursive') not in (None,'0','false')),headers)
+            if rest[:2] == ['git','blobs'] and len(rest) == 3:
+                data = repo.content(rest[2])
+                if 'raw' in self.headers.get('Accept',''):
+                    return self._send(200,data,headers,'application/vnd.github.raw')
+                return self._send(200,{'sha':rest[2],'size':len(data),'encoding':'base64','content':base64.encodebytes(data).decode()},headers)
+            if rest[:1] in (['tarball'],['zipball']) and len(rest) == 2:
+                kind = 'tar' if rest[0] == 'tarball' else 'zip'
+                return self._send(200,repo.archive(rest[1],kind),headers,'application/x-gzip' if kind == 'tar' else 'application/zip')
+        except KeyError:
+            pass
+        self._notfound(headers)
+
+    def do_POST(self):
+        u = urlparse(self.path)
+        if u.path.startswith(CONTROL):
+            return self._control(u.path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        headers = self._begin('graphql')
+        if headers is None:
+            return
+        if u.path.rstrip('/').endswith('/graphql') or u.path == '/graphql':
+            variables = body.get('variables') or {}
+            repo = self.state.repos.get("{}/{}".format(variables.get('owner'),variables.get('name')))
+            if repo is not None or 'user(login' in body.get('query',''):
+                return self._send(200,self._graphql(repo,body['query'],variables),headers)
+        if not self._replay(fixturekey('POST',self.path,body),headers):
+            self._notfound(headers)
+
+    # ---- response bodies ---- #
+
+    def _commits(self,repo,path,query,headers):
+        commits = repo.history(query.get('since'),query.get('until'),query.get('path'),query.get('author'))
+        if query.get('sha'):
+            start = next((i for i,c in enumerate(commits) if c['sha'] == query['sha']),len(commits))
+            commits = commits[start:]
+        per_page,page = min(int(query.get('per_page',30)),100),int(query.get('page',1))
+        last = max(1,-(-len(commits)//per_page))
+        links = []
+        def pagelink(p,rel):
+            links.append('<{}{}?{}>; rel="{}"'.format(self.base,path,urlencode({**query,'page':p}),rel))
+        if page > 1:
+            pagelink(page-1,'prev')
+            pagelink(1,'first')
+        if page < last:
+            pagelink(page+1,'next')
+            pagelink(last,'last')
+        if len(links):
+            headers = {**headers,'Link':", ".join(links)}
+        self._send(200,[self._listjson(repo,c) for c in commits[(page-1)*per_page:page*per_page]],headers)
+
+    def _listjson(self,repo,c):
+        url = "{}/repos/{}/commits/{}".format(self.base,repo.fullname,c['sha'])
+        person = {'name':c['author'].title(),'email':c['email'],'date':c['date']}
+        return {
+            'sha':c['sha'],
+            'node_id':"C_"+c['sha'][:20],
+            'commit':{
+                'author':person,'committer':person,'message':c['message'],
+                'tree':{'sha':c['tree'],'url':"{}/repos/{}/git/trees/{}".format(self.base,repo.fullname,c['tree'])},
+                'url':"{}/repos/{}/git/commits/{}".format(self.base,repo.fullname,c['sha']),
+                'comment_count':0,
+            },
+            'url':url,
+            'html_url':"{}/{}/commit/{}".format(self.base,repo.fullname,c['sha']),
+            'author':{'login':c['author'],'id':int(c['author'][3:])+1,'type':'User'},
+            'committer':{'login':c['author'],'id':int(c['author'][3:])+1,'type':'User'},
+            'parents':[{'sha':p,'url':"{}/repos/{}/commits/{}".format(self.base,repo.fullname,p)} for p in c['parents']],
+        }
+
+    def _commitjson(self,repo,c):
+        json = self._listjson(repo,c)
+        json['stats'] = {'total':c['additions']+c['deletions'],'additions':c['additions'],'deletions':c['deletions']}
+        json['files'] = [{**f,'blob_url':"{}/{}/blob/{}/{}".format(self.base,repo.fullname,c['sha'],f['filename'])} for f in c['files']]
+        return json
+
+    def _gitcommitjson(self,repo,c):
+        person = {'name':c['author'].title(),'email':c['email'],'date':c['date']}
+        return {
+            'sha':c['sha'],'author':person,'committer':person,'message':c['message'],
+            'tree':{'sha':c['tree'],'url':"{}/repos/{}/git/trees/{}".format(self.base,repo.fullname,c['tree'])},
+            'parents':[{'sha':p} for p in c['parents']],
+        }
+
+    def _treejson(self,repo,ref,recursive):
+        tsha = repo.refs[ref]['tree'] if ref in repo.refs else ref
+        entries = repo.walk(tsha) if recursive else ((name,*e) for name,*e in repo.trees[tsha])
+        tree,truncated = [],False
+        for path,kind,sha,mode in entries:
+            if len(tree) == self.state.truncate:
+                truncated = True
+                break
+            entry = {'path':path,'mode':mode,'type':kind,'sha':sha}
+            if kind == 'blob':
+                entry['size'] = repo.blob_size
+                entry['url'] = "{}/repos/{}/git/blobs/{}".format(self.base,repo.fullname,sha)
+            else:
+                entry['url'] = "{}/repos/{}/git/trees/{}".format(self.base,repo.fullname,sha)
+            tree.append(entry)
+        return {'sha':tsha,'url':"{}/repos/{}/git/trees/{}".format(self.base,repo.fullname,tsha),'tree':tree,'truncated':truncated}
+
+    def _graphql(self,repo,query,variables):
+        if 'user(login' in query:
+            return {'data':{'user':{'id':"U_"+variables['login']}}}
+        author = variables.get('author') or {}
+        login = author['id'][2:] if 'id' in author else (author.get('emails') or [None])[0]
+        commits = repo.history(variables.get('since'),variables.get('until'),variables.get('path'),login)
+        start,n = int(variables.get('cursor') or 0),variables['n']
+        nodes = [{
+            'oid':c['sha'],'message':c['message'],'committedDate':c['date'],'additions':c['additions'],'deletions':c['deletions'],
+            'tree':{'oid':c['tree']},'parents':{'nodes':[{'oid':p} for p in c['parents']]},
+        } for c in commits[start:start+n]]
+        history = {'pageInfo':{'hasNextPage':start+n < len(commits),'endCursor':str(start+n)},'nodes':nodes}
+        return {'data':{'repository':{'defaultBranchRef':{'target':{'history':history}}}}}
+
+
+def serve(state,host='127.0.0.1',port=0):
+    """Starts a stub server on a daemon thread, returns the server (its url is served_url(server))"""
+    handler = type('Handler',(StubHandler,),{'state':state})
+    server = ThreadingHTTPServer((host,port),handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+def served_url(server):
+    return "http://{}:{}".format(*server.server_address[:2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Github api stand-in for ghrepo benchmarks')
+    parser.add_argument('--host',type=str,default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=0,help='Port to listen on (0 for any free port)')
+    parser.add_argument('--repo',type=str,action='append',default=[],metavar='SPEC',help="Synthetic repository 'name:key=value,...' (eg 'big:files=1000000,depth=4'), served as bench/name")
+    parser.add_argument('--replay',type=str,action='append',default=[],metavar='FIXTURE',help='Recorded fixture file to replay')
+    parser.add_argument('--latency',type=float,default=0,metavar='MS',help='Latency added to every response')
+    parser.add_argument('--truncate',type=int,default=100000,metavar='N',help='Entries after which a tree listing is truncated')
+    parser.add_argument('--ratelimit',type=int,default=5000,metavar='N',help='Requests allowed per rate limit window')
+    parser.add_argument('--window',type=float,default=3600,metavar='SECONDS',help='Length of the rate limit window')
+    parser.add_argument('--error-rate',type=float,default=0,metavar='P',help='Fraction of requests answered with a 502')
+    parser.add_argument('--throttle-rate',type=float,default=0,metavar='P',help='Fraction of requests refused by a secondary rate limit')
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    repos = [SyntheticRepo.fromspec(spec) for spec in (args.repo or ([] if args.replay else ['repo']))]
+    state = StubState(repos,Fixtures(args.replay),args.latency/1000,args.truncate,args.ratelimit,args.window,args.error_rate,args.throttle_rate)
+    server = serve(state,args.host,args.port)
+    for r in repos:
+        print("{}: {} commits, {} trees, {} blobs".format(r.fullname,len(r.commits),len(r.trees),len(r.blobs)),file=sys.stderr)
+    print("generated in {:.1f}s".format(time.perf_counter()-t0),file=sys.stderr)
+    # the first line of stdout is the url, for scripts starting the stub as a subprocess
+    print(served_url(server),flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,73 +2,317 @@
 #!/usr/bin/env python
 
 import sys,re,os
-import pydecorator
-from .session import GHSession
-from .util import cmp_iso
-
-# ----------- Sort Commits ----------- #
-
-@pydecorator.mergesort(duplicate_values=True)
-def sort_commits(a,b):
-    return cmp_iso(a['date'],b['date'])
+from .scheduler import RequestError
 
 # -------------- Commands -------------- #
 
+def _lscommits(session,args):
+    # history with line stats comes from the graphql api, in 100 commit pages
+    if args.graphql or not args.format.codes.isdisjoint('AD'):
+        return session.iter_history(since=args.since,until=args.until,path=args.path,author=args.author)
+    return session.iter_commits(since=args.since,until=args.until,path=args.path,author=args.author)
+
 def _ls(session,args):
-    from .util import ls_commit_format
-    commits = session.allcommits()
+    from .util import sort_commits,commit_range
+    commits = _lscommits(session,args)
+    if args.stream:
+        # print in api order (newest first) as pages arrive, paging stops once the limit is reached
+        n = 0
+        for c in commits:
+            if args.limit is not None and n >= args.limit:
+                break
+            print(args.format(c),file=sys.stdout)
+            n = n+1
+        commits.close()
+        print("{} Commits listed from repository '{}'".format(n,session.repo),file=sys.stderr)
+        return
+    commits = [*commits]
     print("{} Commits in repository '{}'".format(len(commits),session.repo),file=sys.stderr)
-    for c in sort_commits(commits):
-        print(ls_commit_format(c,args.format),file=sys.stdout)
+    commits = commit_range(sort_commits(commits),args.since,args.until,args.limit)
+    for c in (reversed(commits) if args.reverse else commits):
+        print(args.format(c),file=sys.stdout)
+
 
+def _lsoffline(args):
+    """ls answered from the local commit index, without any api request"""
+    from .index import CommitIndex
+    repo = args.repo if '/' in args.repo else "{}/{}".format(args.username,args.repo)
+    with CommitIndex(args.cache_dir) as index:
+        commits = index.commits(repo,since=args.since,until=args.until,path=args.path,author=args.author,limit=args.limit)
+    if args.output != 'text':
+        write = _recordwriter(args.output)
+        for c in commits:
+            write({**c,'repo':repo})
+        return
+    print("{} Commits in index for '{}'".format(len(commits),repo),file=sys.stderr)
+    for c in (commits if args.reverse else reversed(commits)):
+        print(args.format(c),file=sys.stdout)
+
+def _index(session,args):
+    from .index import CommitIndex
+    with CommitIndex(args.cache_dir) as index:
+        n = index.update(session)
+    print("{} new commits indexed for '{}'".format(n,session.fullname),file=sys.stderr)
+
+def _downloader(session,args):
+    """Returns download(commit,endpath,progress=None) for the session, exporting from the blob store with --dedup"""
+    if args.dedup:
+        from .blobstore import BlobStore
+        store = BlobStore(args.blob_dir or os.path.join(args.cache_dir,'blobs'))
+        return lambda c,endpath,progress=None:session.export_commit(c['thash'],endpath,store,progress,c['hash'])
+    return lambda c,endpath,progress=None:session.download_commit(c['hash'],endpath,progress)
 
 def _get(session,args):
-    from .util import get_commit_format
     if args.commit == None:
         commits = session.allcommits()
         print("{} Commits in repository '{}'".format(len(commits),session.repo),file=sys.stderr)
     else:
         commits = [session.commitinfo(args.commit)]
+    # resolve targets & prompts before any download starts
+    targets = []
     for c in commits:
-        dirname = get_commit_format(c,args.format)
+        dirname = args.format(c)
         endpath = os.path.join(os.getcwd(),dirname)
         if os.path.exists(endpath):
             print("Cannot download commit from '{}' repository, '{}' already exists in this directory".format(session.repo,dirname),file=sys.stderr)
             continue
         if args.verify and input("Download '{}' (y/n) [y]:".format(dirname)).lower() != 'y':
             continue
-        print("Downloading '{}'".format(dirname),file=sys.stderr)
-        session.download_commit(c['hash'],endpath)
+        targets.append((c,dirname,endpath))
+    download = _downloader(session,args)
+    if args.jobs <= 1:
+        for c,dirname,endpath in targets:
+            print("Downloading '{}'".format(dirname),file=sys.stderr)
+            download(c,endpath)
+        return
+    _getparallel(download,targets,args.jobs)
+
+def _getparallel(download,targets,jobs):
+    """Downloads targets on jobs threads, exits with status 1 once all are done if any failed"""
+    from concurrent.futures import ThreadPoolExecutor,as_completed
+    from .util import DownloadProgress,cli_warning
+    progress,failed = DownloadProgress(len(targets)),[]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(download,c,endpath,progress.received):dirname for c,dirname,endpath in targets}
+        for f in as_completed(futures):
+            e = f.exception()
+            if e is not None and not isinstance(e,(RequestError,OSError)):
+                # a bug rather than a failed download, stop queued downloads & raise it
+                for pending in futures:
+                    pending.cancel()
+                progress.close()
+                raise e
+            if e is not None:
+                failed.append((futures[f],e))
+            progress.finished(e is None)
+    progress.close()
+    for dirname,e in failed:
+        cli_warning("Failed to download '{}': {}".format(dirname,e))
+    if len(failed):
+        sys.exit(1)
 
 def _tree(session,args):
-    from .util import ls_commit_format,cli_color
+    from .util import cli_color
     ctree = session.commit_tree(args.commit,filetype=args.filetype,exclude=args.exclude,include=args.include)
-    print(cli_color(ls_commit_format(ctree,args.format),36),file=sys.stdout)
-    print(ctree.tree(),file=sys.stdout)
+    print(cli_color(args.format(ctree),36),file=sys.stdout)
+    for line in ctree.itertree():
+        print(line,file=sys.stdout)
 
 def _cfile(session,args):
-    from .util import ls_commit_format,cli_color
-    from .tree import changestr,maketree
+    from .util import cli_color
+    from .tree import changestr,itertree
     info,cfiles = session.commitfiles(args.commit)
-    ctree = ["{} Files{}".format(len(cfiles),changestr(info['additions'],info['deletions']))]+maketree(cfiles)
-    print(cli_color(ls_commit_format(info,args.format),36),file=sys.stdout)
-    print("\n".join(ctree),file=sys.stdout)
+    print(cli_color(args.format(info),36),file=sys.stdout)
+    print("{} Files{}".format(len(cfiles),changestr(info['additions'],info['deletions'])),file=sys.stdout)
+    for line in itertree(cfiles):
+        print(line,file=sys.stdout)
+
+def _diff(session,args):
+    from .util import cli_color
+    from .tree import itertree
+    files = session.diff(args.base,args.head,filetype=args.filetype,exclude=args.exclude,include=args.include)
+    print(cli_color("{}..{}".format(args.base,args.head),36),file=sys.stdout)
+    print("{} Files".format(len(files)),file=sys.stdout)
+    for line in itertree(files):
+        print(line,file=sys.stdout)
+
+# -------------- Records -------------- #
+
+def _filerecord(f):
+    from .tree import ChangedCommitFile
+    record = {'path':str(f),'sha':f.sha}
+    if isinstance(f,ChangedCommitFile):
+        record.update(status=f.status,additions=f.additions,deletions=f.deletions,prevpath=f.prevpath)
+    return record
+
+def _lsrecords(session,args,commit=None):
+    """One record per commit, newest first"""
+    commits = _lscommits(session,args)
+    for n,c in enumerate(commits):
+        if args.limit is not None and n >= args.limit:
+            break
+        yield c
+    commits.close()
+
+def _cfilerecords(session,args,commit):
+    """One record per file changed by the commit"""
+    info,cfiles = session.commitfiles(commit)
+    for f in cfiles:
+        yield {'commit':info['hash'],**_filerecord(f)}
+
+def _treerecords(session,args,commit):
+    """One record per file in the commit's tree in api order, with change stats for the files it changed"""
+    from .pathfilter import PathFilter
+    from .tree import CommitFile
+    info,cfiles = session.commitfiles(commit)
+    changed = {str(f):f for f in cfiles}
+    pathfilter = PathFilter(args.filetype,args.exclude,args.include)
+    for path,sha in session.filetree_sha(info['thash'],pathfilter.prune if pathfilter else None):
+        f = changed.pop(path,None)
+        if f is None:
+            f = CommitFile(path,sha)
+            if pathfilter and not pathfilter(f):
+                continue
+        yield {'commit':info['hash'],**_filerecord(f)}
+    # files the commit removed
+    for f in changed.values():
+        yield {'commit':info['hash'],**_filerecord(f)}
+
+def _diffrecords(session,args,commit=None):
+    """One record per file that differs between the two commits"""
+    for f in session.diff(args.base,args.head,filetype=args.filetype,exclude=args.exclude,include=args.include):
+        yield {'base':args.base,'head':args.head,**_filerecord(f)}
+
+def _indexrecords(session,args,commit=None):
+    """One record per repository, with the number of commits newly indexed"""
+    from .index import CommitIndex
+    with CommitIndex(args.cache_dir) as index:
+        yield {'indexed':index.update(session)}
+
+def _getrecords(session,args,commit=None):
+    """One record per commit download in commit order, with its status ('exists','downloaded' or 'failed')"""
+    commits = session.allcommits() if commit is None else [session.commitinfo(commit)]
+    download = _downloader(session,args)
+    def fetch(c):
+        dirname = args.format(c)
+        endpath = os.path.join(os.getcwd(),dirname)
+        record = {'hash':c['hash'],'path':dirname}
+        if os.path.exists(endpath):
+            return {**record,'status':'exists'}
+        try:
+            download(c,endpath)
+        except (RequestError,OSError) as e:
+            return {**record,'status':'failed','error':str(e)}
+        return {**record,'status':'downloaded'}
+    if args.jobs <= 1:
+        yield from map(fetch,commits)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        yield from pool.map(fetch,commits)
+
+def _recordwriter(output):
+    """Returns write(record), printing records to stdout as JSON Lines or as a stream of msgpack maps"""
+    if output == 'msgpack':
+        import msgpack
+        packer = msgpack.Packer()
+        return lambda record:sys.stdout.buffer.write(packer.pack(record))
+    import json
+    return lambda record:print(json.dumps(record,separators=(',',':')),file=sys.stdout)
+
+def _writerecords(session,args,commit,write):
+    for record in args.records(session,args,commit):
+        write({'repo':session.fullname,**{k:v for k,v in record.items() if k != 'repo'}})
+
+# -------------- Batch Mode -------------- #
+
+def _readrepos(path):
+    """Reads 'REPOSITORY [COMMIT]' lines from a file ('-' for stdin), skipping blank lines & '#' comments"""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        repos = []
+        for line in f:
+            fields = line.split('#',1)[0].split()
+            if len(fields):
+                repos.append((fields[0],fields[1] if len(fields) > 1 else None))
+        return repos
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def _session(args,repo,**kwargs):
+    from .session import GHSession
+    return GHSession(args.username,args.password,repo,token=args.token,**kwargs)
+
+def _batch(args,cache):
+    """
+    Runs the command across every repository of args.repos concurrently, printing its records tagged by repo.
+    All sessions share one scheduler, so one connection pool & rate limit budget
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from .scheduler import RequestScheduler
+    from .session import TruncatedError
+    scheduler,lock,write = RequestScheduler(workers=args.workers),threading.Lock(),_recordwriter(args.output)
+    def emit(record):
+        with lock:
+            write(record)
+    def run(repo,commit):
+        if '/' not in repo and args.username is None:
+            emit({'repo':repo,'error':"No owner for repository '{}', use 'owner/name' or -u".format(repo)})
+            return False
+        with _session(args,repo,cache=cache,scheduler=scheduler) as session:
+            try:
+                _writerecords(session,args,commit or getattr(args,'commit',None),emit)
+            except (RequestError,TruncatedError,OSError) as e:
+                # a failed repository is reported as a record, the others carry on
+                emit({'repo':session.fullname,'error':str(e)})
+                return False
+        return True
+    try:
+        with ThreadPoolExecutor(max_workers=args.repo_jobs) as pool:
+            ok = all([*pool.map(lambda x:run(*x),_readrepos(args.repos))])
+    finally:
+        scheduler.close()
+        if args.stats:
+            print(scheduler.stats,file=sys.stderr)
+    if not ok:
+        sys.exit(1)
 
 
 def main():
     import argparse,getpass
+    from .util import compile_ls_format,compile_get_format,isodate
     parser = argparse.ArgumentParser(prog='ghrepo',description='Github Repo Tools')
     subparsers = parser.add_subparsers(title="Available sub commands",metavar='command')
 
     base_parser = argparse.ArgumentParser(add_help=False)
-    base_parser.add_argument('-u',type=str,dest='username',metavar='USERNAME',required=True,help='Github Username')
+    base_parser.add_argument('-u',type=str,dest='username',metavar='USERNAME',help='Github Username, also the owner of repositories given without one')
     base_parser.add_argument('-p',type=str,dest='password',metavar='PASSWORD',help='Github Password')
-    base_parser.add_argument('-r',type=str,dest='repo',metavar='REPOSITORY',required=True,help='Target Github Repository')
+    base_parser.add_argument('-t','--token',type=str,metavar='TOKEN',help='Github access token (default: $GITHUB_TOKEN or $GH_TOKEN), used instead of a password')
+    base_repo = base_parser.add_mutually_exclusive_group(required=True)
+    base_repo.add_argument('-r',type=str,dest='repo',metavar='REPOSITORY',help='Target Github Repository (name, or owner/name)')
+    base_repo.add_argument('--repos',type=str,metavar='FILE',help="Run across the repositories listed in FILE ('-' for stdin), one 'REPOSITORY [COMMIT]' per line, printing JSON Lines")
+    base_parser.add_argument('--repo-jobs',type=int,dest='repo_jobs',default=4,metavar='N',help='Number of repositories processed concurrently with --repos')
+    base_parser.add_argument('-w','--workers',type=int,default=4,metavar='N',help='Max number of concurrent api requests')
+    base_parser.add_argument('--cache-dir',type=str,dest='cache_dir',metavar='DIR',help='Directory of the local commit & tree cache (default: $XDG_CACHE_HOME/ghrepo)')
+    base_parser.add_argument('--no-cache',action='store_true',dest='no_cache',help='Do not read or write the local cache')
+    base_parser.add_argument('--stats',action='store_true',help='Print request statistics to stderr when done')
+    base_parser.add_argument('-o','--output',choices=('text','jsonl','msgpack'),help='Output text, or stream one record per commit / file as JSON Lines or msgpack (default: text, jsonl with --repos)')
     # ------------------------------------------------ ls ------------------------------------------------ #
 
     parser_ls = subparsers.add_parser('ls',parents=[base_parser], help='list commits for repository',description="list commits for github repository")
     parser_ls.add_argument('-f','--format',type=str,default="%h %d %t\n%M",help='Display format for each commit')
-    parser_ls.set_defaults(run=_ls)
+    parser_ls.add_argument('--since',type=isodate,metavar='DATE',help='Only list commits at or after DATE (YYYY-MM-DD[THH:MM:SS])')
+    parser_ls.add_argument('--until',type=isodate,metavar='DATE',help='Only list commits at or before DATE (YYYY-MM-DD[THH:MM:SS])')
+    parser_ls.add_argument('-n','--limit',type=int,metavar='N',help='Only list the N most recent commits')
+    parser_ls.add_argument('--reverse',action='store_true',help='List the most recent commits first')
+    parser_ls.add_argument('--path',type=str,metavar='PATH',help='Only list commits touching PATH')
+    parser_ls.add_argument('--author',type=str,metavar='AUTHOR',help='Only list commits by AUTHOR (login or email)')
+    parser_ls.add_argument('-s','--stream',action='store_true',help='Print commits newest first as they are fetched, without sorting')
+    parser_ls.add_argument('-g','--graphql',action='store_true',help='Fetch history with line stats from the GraphQL api (implied by %%A / %%D)')
+    parser_ls.add_argument('--offline',action='store_true',help="Answer from the local commit index (see 'ghrepo index') without contacting github")
+    parser_ls.set_defaults(run=_ls,records=_lsrecords,formatter=compile_ls_format)
 
     # ------------------------------------------------ get ------------------------------------------------ #
 
@@ -76,31 +320,106 @@ def main():
     parser_get.add_argument('-c','--commit',type=str,help='Optional hash of commit to target')
     parser_get.add_argument('-v','--verify',action='store_true',help='Verify each commit before download')
     parser_get.add_argument('-f','--format',type=str,default="%r-%d_%t_%h",help='Naming format for downloaded directory')
-    parser_get.set_defaults(run=_get)
+    parser_get.add_argument('-j','--jobs',type=int,default=1,metavar='N',help='Number of commits to download concurrently')
+    parser_get.add_argument('--dedup',action='store_true',help='Export snapshots from a local blob store, fetching only changed files')
+    parser_get.add_argument('--blob-dir',type=str,dest='blob_dir',metavar='DIR',help='Blob store directory for --dedup (default: CACHE_DIR/blobs)')
+    parser_get.set_defaults(run=_get,records=_getrecords,formatter=compile_get_format)
 
     # ------------------------------------------------ cfile ------------------------------------------------ #
 
     parser_cfile = subparsers.add_parser('cfile',parents=[base_parser], help='print commit file changes',description="commit file changes")
-    parser_cfile.add_argument('-c','--commit',type=str,required=True,help='hash of commit to get changed files for')
+    parser_cfile.add_argument('-c','--commit',type=str,default='HEAD',help='hash of commit to get changed files for (default: HEAD)')
     parser_cfile.add_argument('-f','--format',type=str,default="%r-%d_%t_%h",help='display format for tree header')
-    parser_cfile.set_defaults(run=_cfile)
+    parser_cfile.set_defaults(run=_cfile,records=_cfilerecords,formatter=compile_ls_format)
 
     # ------------------------------------------------ tree ------------------------------------------------ #
 
     parser_tree = subparsers.add_parser('tree',parents=[base_parser], help='print commit as tree',description="commit file trees")
-    parser_tree.add_argument('-c','--commit',type=str,required=True,help='hash of commit for file tree')
+    parser_tree.add_argument('-c','--commit',type=str,default='HEAD',help='hash of commit for file tree (default: HEAD)')
     parser_tree.add_argument('-f','--format',type=str,default="%r-%d_%t_%h",help='display format for tree header')
     parser_tree.add_argument('-ft','--filetype',dest='filetype',action='append',metavar='filetype',help='file type filter')
     parser_tree_paths = parser_tree.add_mutually_exclusive_group(required=False)
     parser_tree_paths.add_argument('-exc','--exclude',dest='exclude',action='append',metavar='path',help='paths to exclude from tree')
     parser_tree_paths.add_argument('-inc','--include',dest='include',action='append',metavar='path',help='paths to include in tree')
-    parser_tree.set_defaults(run=_tree)
+    parser_tree.set_defaults(run=_tree,records=_treerecords,formatter=compile_ls_format)
+
+    # ------------------------------------------------ index ------------------------------------------------ #
+
+    parser_index = subparsers.add_parser('index',parents=[base_parser], help='update the local commit index',description="indexes new commits of a repository for 'ls --offline' queries")
+    parser_index.set_defaults(run=_index,records=_indexrecords,formatter=None,format=None)
+
+    # ------------------------------------------------ diff ------------------------------------------------ #
+
+    parser_diff = subparsers.add_parser('diff',parents=[base_parser], help='print files changed between two commits',description="compares the file trees of two commits")
+    parser_diff.add_argument('base',type=str,help='hash (or branch / tag) of the base commit')
+    parser_diff.add_argument('head',type=str,help='hash (or branch / tag) of the head commit')
+    parser_diff.add_argument('-ft','--filetype',dest='filetype',action='append',metavar='filetype',help='file type filter')
+    parser_diff_paths = parser_diff.add_mutually_exclusive_group(required=False)
+    parser_diff_paths.add_argument('-exc','--exclude',dest='exclude',action='append',metavar='path',help='paths to exclude from diff')
+    parser_diff_paths.add_argument('-inc','--include',dest='include',action='append',metavar='path',help='paths to include in diff')
+    parser_diff.set_defaults(run=_diff,records=_diffrecords,formatter=None,format=None)
 
 
     args = parser.parse_args()
-    if args.password == None:
-        password = getpass.getpass("github password:")
-    else:
-        password = args.password
-    session = GHSession(args.username,password,args.repo)
-    args.run(session,args)
+    try:
+        if args.formatter is not None:
+            args.format = args.formatter(args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output is None:
+        args.output = 'text' if args.repos is None else 'jsonl'
+    if args.output != 'text' and getattr(args,'verify',False):
+        parser.error("--verify can only be used with text output")
+    if args.output != 'text' and getattr(args,'reverse',False):
+        parser.error("--reverse can only be used with text output, records are listed newest first")
+    if args.output == 'text' and args.repos is not None:
+        parser.error("--repos cannot be used with text output")
+    if args.output == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            parser.error("--output msgpack requires the msgpack package (pip install ghrepo[msgpack])")
+    if args.repo is not None and '/' not in args.repo and args.username is None:
+        parser.error("no owner for repository '{}', use 'owner/name' or -u".format(args.repo))
+    from .cache import ObjectCache,default_cache_dir
+    args.cache_dir = args.cache_dir or default_cache_dir()
+    if getattr(args,'offline',False):
+        if args.repos is not None:
+            parser.error("--offline cannot be used with --repos")
+        _lsoffline(args)
+        return
+    # a token is preferred, the password prompt is only a fallback. an explicit -p is never overridden from the environment
+    if args.token is None and args.password is None:
+        args.token = os.environ.get('GITHUB_TOKEN') or os.environ.get('GH_TOKEN')
+    if args.token is None and args.password is None:
+        if args.username is None:
+            parser.error("a token (-t, $GITHUB_TOKEN or $GH_TOKEN) or a username is required")
+        args.password = getpass.getpass("github password:")
+    cache = None if args.no_cache else ObjectCache(args.cache_dir)
+    if args.repos is not None:
+        try:
+            _batch(args,cache)
+        finally:
+            if cache is not None:
+                cache.close()
+        return
+    try:
+        with _session(args,args.repo,workers=args.workers,cache=cache) as session:
+            try:
+                if args.output == 'text':
+                    args.run(session,args)
+                else:
+                    _writerecords(session,args,getattr(args,'commit',None),_recordwriter(args.output))
+            finally:
+                if args.stats:
+                    print(session.stats,file=sys.stderr)
+    except RequestError as e:
+        print(e,file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == '__main__':
+    main()
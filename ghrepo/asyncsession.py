@@ -0,0 +1,305 @@
+import asyncio,json,os,shutil,tarfile,tempfile,time
+from collections import deque
+from http import HTTPStatus
+from .scheduler import RequestError,RequestStats,ratelimited,retry_delay
+from .session import GHSessionBase,_HistorySync,_extracttar,_BUFSIZE,_TARBUFSIZE
+from .pathfilter import PathFilter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+__all__ = ["AsyncGHSession"]
+
+def _extractfile(fileobj,topath):
+    with tarfile.open(fileobj=fileobj,mode='r|gz',bufsize=_TARBUFSIZE) as tar:
+        _extracttar(tar,topath)
+
+
+class AsyncGHSession(GHSessionBase):
+    """
+    asyncio variant of GHSession on a non-blocking aiohttp client. Its methods are coroutines (or async generators)
+    mirroring those of GHSession, and share its url building, response parsing & tree assembly.
+    Use it as an async context manager, or await close() when done
+    """
+    def __init__(self,username,password,repository,concurrency=8,retries=3,backoff=0.5,cache=None,token=None):
+        """
+        token -> optional access token, used instead of the username & password
+        cache -> optional ObjectCache serving commit & tree json by object sha
+        concurrency -> max number of api requests in flight
+        retries -> number of retries for connection errors, 5xx & rate limited responses
+        backoff -> exponential backoff factor (seconds) between retries
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncGHSession requires aiohttp (pip install ghrepo[async])")
+        super().__init__(username,password,repository,cache,token)
+        self.concurrency = max(concurrency,1)
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = RequestStats()
+        self._http = None
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc):
+        await self.close()
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    @property
+    def http(self):
+        # created on first use, so the client & its semaphore bind to the running event loop
+        if self._http is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            auth = None if self.token else aiohttp.BasicAuth(self.user,self.pw)
+            self._http = aiohttp.ClientSession(auth=auth,headers=self._headers(),connector=connector)
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._http
+
+    async def _imap(self,fn,items):
+        """Ordered map of coroutine fn over items, with a bounded number of calls in flight"""
+        pending = deque()
+        try:
+            for x in items:
+                pending.append(asyncio.ensure_future(fn(x)))
+                if len(pending) >= 2*self.concurrency:
+                    yield await pending.popleft()
+            while len(pending):
+                yield await pending.popleft()
+        finally:
+            for t in pending:
+                t.cancel()
+
+    async def _fetch(self,url,headers=None,sink=None):
+        """
+        Issues a GET request, retrying connection errors, 5xx & rate limited responses. Returns (status,headers,body,links).
+        Retries wait out their backoff without holding a concurrency slot.
+        sink -> optional coroutine function receiving the body of a successful response chunk by chunk, instead of it being returned
+        """
+        http = self.http
+        for attempt in range(self.retries+1):
+            received,failed = 0,False
+            async with self._slots:
+                t0 = time.perf_counter()
+                try:
+                    async with http.get(url,headers=headers) as r:
+                        status,rheaders = r.status,r.headers
+                        links = {rel:{'url':str(v['url'])} for rel,v in r.links.items()}
+                        if sink is not None and status < 300:
+                            body = b''
+                            async for chunk in r.content.iter_chunked(_BUFSIZE):
+                                received += len(chunk)
+                                await sink(chunk)
+                        else:
+                            body = await r.read()
+                except aiohttp.ClientError as e:
+                    # a partially received body cannot be resumed
+                    if attempt == self.retries or received:
+                        raise RequestError(url,str(e)) from e
+                    failed = True
+                else:
+                    self.stats.record(time.perf_counter()-t0,received+len(body))
+            if failed:
+                self.stats.count(retries=1)
+                await asyncio.sleep(self.backoff*(2**attempt))
+                continue
+            if attempt < self.retries and (status in (500,502,503,504) or ratelimited(status,rheaders,body)):
+                delay = retry_delay(rheaders,attempt,self.backoff)
+                self.stats.count(retries=1,throttled=delay)
+                await asyncio.sleep(delay)
+                continue
+            return status,rheaders,body,links
+
+    @staticmethod
+    def _errormessage(status,body):
+        try:
+            return "{} {}".format(status,json.loads(body)['message'])
+        except (ValueError,KeyError,TypeError):
+            try:
+                return "{} {}".format(status,HTTPStatus(status).phrase)
+            except ValueError:
+                return str(status)
+
+    async def _get(self,url,conditional=False):
+        """
+        Returns (json,links) where links is the parsed 'Link' header.
+        conditional -> revalidate a stored response with If-None-Match / If-Modified-Since, a 304 is served from the cache
+        """
+        stored,headers = None,{}
+        if conditional and self.cache is not None:
+            stored = self.cache.getresponse(url)
+            if stored is not None:
+                etag,modified,_ = stored
+                if etag: headers['If-None-Match'] = etag
+                if modified: headers['If-Modified-Since'] = modified
+        status,rheaders,body,links = await self._fetch(url,headers)
+        if stored is not None and status == 304:
+            self.stats.count(cache_hits=1)
+            return tuple(stored[2])
+        if status >= 400:
+            raise RequestError(url,self._errormessage(status,body),status)
+        data = json.loads(body)
+        if conditional and self.cache is not None and ('ETag' in rheaders or 'Last-Modified' in rheaders):
+            self.cache.putresponse(url,rheaders.get('ETag'),rheaders.get('Last-Modified'),[data,links])
+        return data,links
+
+    async def _getjson(self,url):
+        return (await self._get(url))[0]
+
+    async def _getobject(self,kind,sha,url):
+        """Fetches json for an immutable object, served from the cache when sha is a full object hash"""
+        key = self._cachekey(kind,sha)
+        if key is None:
+            return await self._getjson(url)
+        data = self.cache.get(key)
+        if data is not None:
+            self.stats.count(cache_hits=1)
+            return data
+        data = await self._getjson(url)
+        self._cacheobject(key,data)
+        return data
+
+    async def _pages(self,endpoint,query=None,per_page=100,conditional=False):
+        """
+        Yields each page of a paginated endpoint in order, fetching pages concurrently once the last page is known.
+        query -> optional dict of additional query parameters
+        conditional -> fetch pages one at a time with conditional requests, for callers that expect to stop early
+        """
+        pageurl = self._pageurl(endpoint,query,per_page)
+        batch,links = await self._get(pageurl(1),conditional)
+        yield batch
+        if 'last' in links and not conditional:
+            last = self._lastpage(links['last']['url'])
+            async for batch in self._imap(self._getjson,[pageurl(p) for p in range(2,last+1)]):
+                yield batch
+            return
+        # no Link header -> probe pages one at a time
+        page = 1
+        while len(batch)==per_page:
+            page = page+1
+            batch = (await self._get(pageurl(page),conditional))[0]
+            yield batch
+
+    # ---- commits ---- #
+
+    async def commitinfo(self,chash):
+        url = self._apiurl("git/commits/{}".format(chash))
+        return self._gitcommitrecord(await self._getobject('gitcommit',chash,url))
+
+    async def iter_commits(self,since=None,until=None,path=None,author=None):
+        """Lazily yields commit records newest first, as their pages arrive. Filters are those of GHSession.iter_commits"""
+        query = self._commitsquery(since,until,path,author)
+        if len(query) or self.cache is None:
+            async for batch in self._pages("commits",query):
+                for data in batch:
+                    yield self._commitrecord(data)
+            return
+        history = self.cache.get(self._historykey)
+        commits = []
+        async for c in (self._listcommits() if history is None else self._synccommits(history)):
+            commits.append(c)
+            yield c
+        self.cache.put(self._historykey,commits)
+
+    async def allcommits(self,**filters):
+        """Returns all commits in the repository, filters are those of iter_commits"""
+        return [c async for c in self.iter_commits(**filters)]
+
+    async def _listcommits(self):
+        async for batch in self._pages("commits"):
+            for data in batch:
+                yield self._commitrecord(data)
+
+    async def _synccommits(self,history):
+        sync = _HistorySync(history)
+        pages = self._pages("commits",conditional=True)
+        async for batch in pages:
+            for data in batch:
+                c = sync.feed(data['sha'],lambda:self._commitrecord(data))
+                if c is not None:
+                    yield c
+                if sync.done:
+                    break
+            else:
+                continue
+            await pages.aclose()
+            break
+        for c in sync.tail():
+            yield c
+
+    async def commitfiles(self,chash):
+        url = self._apiurl("commits/{}".format(chash))
+        return self._commitfiles(await self._getobject('commit',chash,url))
+
+    # ---- trees ---- #
+
+    async def _treejson(self,thash,recursive=False):
+        url = self._apiurl("git/trees/{}{}".format(thash,"?recursive=1" if recursive else ""))
+        return await self._getobject('rtree' if recursive else 'tree',thash,url)
+
+    async def filetree_entries(self,thash,prune=None):
+        """
+        Yields (path,sha,mode) for each file in a tree. The whole tree is requested in a single recursive call,
+        subtrees of a truncated response are fetched concurrently (each again recursively first).
+        prune -> optional callable taking a split directory path, subtrees it returns True for are not fetched
+        """
+        async def fetch(x):
+            return x,await self._treejson(x[1],x[2])
+        pending = [('',thash,True)]
+        while len(pending):
+            subtrees = []
+            async for (prefix,sha,recursive),data in self._imap(fetch,pending):
+                files,more = self._treeentries(prefix,sha,recursive,data,prune)
+                for f in files:
+                    yield f
+                subtrees.extend(more)
+            pending = subtrees
+
+    async def filetree_sha(self,thash,prune=None):
+        """Yields (path,sha) for each file in a tree"""
+        async for path,sha,mode in self.filetree_entries(thash,prune):
+            yield path,sha
+
+    async def filetree(self,thash):
+        return [f async for f,sha in self.filetree_sha(thash)]
+
+    async def commit_tree(self,sha,filetype=None,exclude=None,include=None):
+        """Coroutine counterpart of GHSession.commit_tree"""
+        url = self._apiurl("commits/{}".format(sha))
+        data = await self._getobject('commit',sha,url)
+        pathfilter = PathFilter(filetype,exclude,include)
+        filetree = [x async for x in self.filetree_sha(data["commit"]['tree']['sha'],pathfilter.prune if pathfilter else None)]
+        return self._committree(data,filetree,pathfilter)
+
+    # ---- downloads ---- #
+
+    async def download_commit(self,chash,topath,progress=None):
+        """
+        Downloads the commit's tarball to a temporary file, then extracts it into topath. Chunk writes &
+        the extraction run on worker threads, so the event loop is never blocked on disk or decompression.
+        progress -> optional callable receiving the number of bytes of each chunk received
+        """
+        url = self._apiurl("tarball/{}".format(chash))
+        partpath = topath+".part"
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryFile() as tmp:
+            async def sink(chunk):
+                await loop.run_in_executor(None,tmp.write,chunk)
+                if progress is not None:
+                    progress(len(chunk))
+            status,_,body,_ = await self._fetch(url,sink=sink)
+            if status >= 400:
+                raise RequestError(url,self._errormessage(status,body),status)
+            tmp.seek(0)
+            try:
+                await loop.run_in_executor(None,_extractfile,tmp,partpath)
+            except BaseException:
+                shutil.rmtree(partpath,ignore_errors=True)
+                raise
+        os.rename(partpath,topath)
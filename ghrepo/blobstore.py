@@ -0,0 +1,57 @@
+import os,shutil,tempfile
+
+__all__ = ["BlobStore"]
+
+class BlobStore():
+    """
+    Content addressed store of file blobs, laid out as path/{sha[:2]}/{sha[2:]}. Executable blobs are stored
+    as separate '.x' copies, since a file's mode is shared by all of its hard links. Stored files are made
+    read-only, so an edit to one exported snapshot cannot silently change the others
+    """
+    def __init__(self,path):
+        self.path = path
+        os.makedirs(path,exist_ok=True)
+
+    def blobpath(self,sha,mode):
+        return os.path.join(self.path,sha[:2],sha[2:]+(".x" if mode == '100755' else ""))
+
+    def has(self,sha,mode):
+        return os.path.exists(self.blobpath(sha,mode))
+
+    def put(self,sha,mode,data):
+        path = self.blobpath(sha,mode)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd,'wb') as f:
+                f.write(data)
+            os.chmod(tmp,0o555 if mode == '100755' else 0o444)
+            os.replace(tmp,path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @staticmethod
+    def _escapes(path):
+        path = os.path.normpath(path)
+        return os.path.isabs(path) or path == '..' or path.startswith('..'+os.sep)
+
+    def materialize(self,sha,mode,root,path):
+        """
+        Creates root/path as a hard link to the stored blob (a copy across devices, a symlink for mode 120000).
+        Paths & symlink targets that would escape root are skipped
+        """
+        if self._escapes(path):
+            return
+        blob,topath = self.blobpath(sha,mode),os.path.join(root,path)
+        os.makedirs(os.path.dirname(topath),exist_ok=True)
+        if mode == '120000':
+            with open(blob,'r') as f:
+                target = f.read()
+            if not self._escapes(os.path.join(os.path.dirname(path),target)):
+                os.symlink(target,topath)
+            return
+        try:
+            os.link(blob,topath)
+        except OSError:
+            shutil.copy2(blob,topath)
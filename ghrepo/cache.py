@@ -0,0 +1,86 @@
+import os,json,sqlite3,threading,time,zlib
+
+__all__ = ["ObjectCache","default_cache_dir"]
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),'.cache')
+    return os.path.join(base,'ghrepo')
+
+
+class ObjectCache():
+    """
+    Persistent store for api json of immutable objects (commits & trees), keyed by object sha.
+    Entries are zlib compressed in a SQLite database, and least recently used entries are evicted
+    once the total stored size exceeds max_size bytes. Responses of mutable endpoints are stored
+    alongside their ETag / Last-Modified validators so they can be revalidated with conditional requests
+    """
+    def __init__(self,path=None,max_size=256*2**20):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+        os.makedirs(self.path,exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.path,'objects.db'),check_same_thread=False,isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, atime REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS objects_atime ON objects (atime)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS validators (url TEXT PRIMARY KEY, etag TEXT, modified TEXT)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size),0) FROM objects").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def get(self,key):
+        """Returns the json stored under key, or None if it is not cached"""
+        with self._lock:
+            row = self._db.execute("SELECT data FROM objects WHERE key=?",(key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE objects SET atime=? WHERE key=?",(time.time(),key))
+        return json.loads(zlib.decompress(row[0]).decode())
+
+    def put(self,key,value):
+        data = zlib.compress(json.dumps(value,separators=(',',':')).encode())
+        with self._lock:
+            row = self._db.execute("SELECT size FROM objects WHERE key=?",(key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO objects (key,data,size,atime) VALUES (?,?,?,?)",(key,data,len(data),time.time()))
+            self._size += len(data)-(row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # drop least recently used entries until the store is back under 90% of max_size
+        self._size = self._db.execute("SELECT COALESCE(SUM(size),0) FROM objects").fetchone()[0]
+        target,keys = self._size-int(self.max_size*0.9),[]
+        for key,size in self._db.execute("SELECT key,size FROM objects ORDER BY atime").fetchall():
+            if target <= 0:
+                break
+            keys.append((key,))
+            target,self._size = target-size,self._size-size
+        self._db.execute("BEGIN")
+        self._db.executemany("DELETE FROM objects WHERE key=?",keys)
+        self._db.execute("COMMIT")
+
+    def getresponse(self,url):
+        """Returns (etag,modified,value) stored for url, or None if there is no stored response"""
+        with self._lock:
+            row = self._db.execute("SELECT etag,modified FROM validators WHERE url=?",(url,)).fetchone()
+        if row is None:
+            return None
+        value = self.get("url:"+url)
+        return None if value is None else (*row,value)
+
+    def putresponse(self,url,etag,modified,value):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO validators (url,etag,modified) VALUES (?,?,?)",(url,etag,modified))
+        self.put("url:"+url,value)
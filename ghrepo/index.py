@@ -0,0 +1,125 @@
+import os,sqlite3,threading
+from .cache import default_cache_dir
+
+__all__ = ["CommitIndex"]
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS commits (repo TEXT NOT NULL, hash TEXT NOT NULL, thash TEXT, date TEXT, time INTEGER, message TEXT, parents TEXT,"
+    " author TEXT, email TEXT, additions INTEGER, deletions INTEGER, PRIMARY KEY (repo,hash))",
+    "CREATE INDEX IF NOT EXISTS commits_time ON commits (repo,time)",
+    "CREATE INDEX IF NOT EXISTS commits_author ON commits (repo,author)",
+    "CREATE INDEX IF NOT EXISTS commits_email ON commits (repo,email)",
+    "CREATE TABLE IF NOT EXISTS changes (repo TEXT NOT NULL, hash TEXT NOT NULL, path TEXT NOT NULL, status TEXT, additions INTEGER, deletions INTEGER, prevpath TEXT)",
+    "CREATE INDEX IF NOT EXISTS changes_path ON changes (repo,path)",
+    "CREATE INDEX IF NOT EXISTS changes_hash ON changes (repo,hash)",
+)
+
+_COLUMNS = ('hash','thash','date','time','message','parents','author','email','additions','deletions')
+
+
+class CommitIndex():
+    """
+    Local SQLite index of repository histories: each commit with its parsed time, author & line stats, and the paths
+    it changed. Path, time range & author queries are answered offline from indexed columns, and updates only fetch
+    commits newer than those already indexed
+    """
+    def __init__(self,path=None):
+        self.path = path or default_cache_dir()
+        os.makedirs(self.path,exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.path,'index.db'),check_same_thread=False,isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def history(self,repo):
+        """Indexed commits of repo ('owner/name') as records with 'hash' & 'parents'"""
+        with self._lock:
+            rows = self._db.execute("SELECT hash,parents FROM commits WHERE repo=? ORDER BY time DESC",(repo,)).fetchall()
+        return [{'hash':h,'parents':p.split()} for h,p in rows]
+
+    def update(self,session,chunk=100):
+        """
+        Indexes the commits of the session's repository newer than the indexed ones, returns how many were added.
+        Changed paths & stats come from a commitfiles call per new commit, fetched concurrently. Commits are stored
+        oldest first, chunk at a time, so an interrupted update resumes where it stopped. Commits no longer in the
+        history (after a force push) are dropped once the update completes
+        """
+        repo = session.fullname
+        new,reachable = session.new_commits(self.history(repo))
+        new.reverse()
+        for i in range(0,len(new),chunk):
+            batch = new[i:i+chunk]
+            rows,changes = [],[]
+            for c,(info,files) in zip(batch,session.iter_commitfiles([c['hash'] for c in batch])):
+                rows.append((repo,c['hash'],c['thash'],c['date'],c['time'],c['message'],' '.join(c['parents']),info['author'],info['email'],info['additions'],info['deletions']))
+                changes.extend((repo,c['hash'],str(f),f.status,f.additions,f.deletions,f.prevpath) for f in files)
+            with self._lock:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO commits VALUES (?,?,?,?,?,?,?,?,?,?,?)",rows)
+                self._db.executemany("DELETE FROM changes WHERE repo=? AND hash=?",[(repo,c['hash']) for c in batch])
+                self._db.executemany("INSERT INTO changes VALUES (?,?,?,?,?,?,?)",changes)
+                self._db.execute("COMMIT")
+        self._prune(repo,{c['hash'] for c in new}.union(reachable))
+        return len(new)
+
+    def _prune(self,repo,keep):
+        with self._lock:
+            stale = [(repo,h) for h, in self._db.execute("SELECT hash FROM commits WHERE repo=?",(repo,)).fetchall() if h not in keep]
+            if not len(stale):
+                return
+            self._db.execute("BEGIN")
+            self._db.executemany("DELETE FROM commits WHERE repo=? AND hash=?",stale)
+            self._db.executemany("DELETE FROM changes WHERE repo=? AND hash=?",stale)
+            self._db.execute("COMMIT")
+
+    def commits(self,repo,since=None,until=None,path=None,author=None,limit=None):
+        """
+        Returns indexed commit records of repo newest first, with their 'additions', 'deletions' & 'author'.
+        since,until -> only commits in this range (epoch seconds)
+        path -> only commits changing this file, or a file beneath this directory
+        author -> only commits by this login, name or email
+        limit -> only the most recent limit commits
+        """
+        sql,params = ["SELECT {} FROM commits WHERE repo=?".format(",".join(_COLUMNS))],[repo]
+        if since is not None:
+            sql.append("AND time>=?")
+            params.append(since)
+        if until is not None:
+            sql.append("AND time<=?")
+            params.append(until)
+        if author is not None:
+            sql.append("AND (author=? OR email=?)")
+            params.extend((author,author))
+        if path is not None:
+            # a directory matches the key range ['dir/','dir0'), '0' being the character after '/'
+            path = path.strip('/')
+            sql.append("AND hash IN (SELECT hash FROM changes WHERE repo=? AND (path=? OR (path>=? AND path<?)))")
+            params.extend((repo,path,path+'/',path+'0'))
+        sql.append("ORDER BY time DESC")
+        if limit is not None:
+            sql.append("LIMIT ?")
+            params.append(limit)
+        with self._lock:
+            rows = self._db.execute(" ".join(sql),params).fetchall()
+        name = repo.rpartition('/')[2]
+        commits = []
+        for row in rows:
+            c = dict(zip(_COLUMNS,row))
+            c['parents'] = c['parents'].split()
+            commits.append({'repo':name,**c})
+        return commits
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM commits").fetchone()[0]
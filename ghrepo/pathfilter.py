@@ -0,0 +1,109 @@
+import re
+from fnmatch import translate
+from .util import splitpath
+
+__all__ = ["PathFilter"]
+
+_isglob = re.compile(r'[*?\[]').search
+
+def _aslist(x):
+    if x is None:
+        return []
+    return [x] if type(x) == str else list(x)
+
+
+class _PathSet():
+    """
+    Compiled set of directory paths & glob patterns. Directory paths are held in a prefix trie and match every
+    file beneath them, glob patterns are combined into a single regex matching a file path or any directory above it
+    """
+    def __init__(self,patterns):
+        self.trie = {}
+        globs = []
+        for p in patterns:
+            if _isglob(p):
+                # translate gives '(?s:body)\Z', the body may match the whole path or one of its directories
+                globs.append("(?:{})(?:/.*)?\\Z".format(translate(p)[:-2]))
+                continue
+            node = self.trie
+            for d in splitpath(p):
+                node = node.setdefault(d,{})
+            node[''] = True
+        self.glob = re.compile('|'.join(globs),re.S).match if len(globs) else None
+
+    def __bool__(self):
+        return len(self.trie) > 0 or self.glob is not None
+
+    def contains(self,path):
+        """True if the split file path is beneath one of the directories or matches a glob"""
+        node = self.trie
+        if '' in node:
+            return True
+        for d in path[:-1]:
+            node = node.get(d)
+            if node is None:
+                break
+            if '' in node:
+                return True
+        return self.glob is not None and self.glob('/'.join(path)) is not None
+
+    def covers(self,dirpath):
+        """True if every file beneath the split directory path is contained"""
+        if self.glob is not None and len(dirpath) and self.glob('/'.join(dirpath)) is not None:
+            return True
+        node = self.trie
+        for d in dirpath:
+            if '' in node:
+                return True
+            node = node.get(d)
+            if node is None:
+                return False
+        return '' in node
+
+    def reaches(self,dirpath):
+        """True if files beneath the split directory path may be contained"""
+        if self.glob is not None:
+            return True
+        node = self.trie
+        for d in dirpath:
+            if '' in node:
+                return True
+            node = node.get(d)
+            if node is None:
+                return False
+        return True
+
+
+class PathFilter():
+    """
+    Single pass file filter for commit trees.
+    filetype -> file extensions to keep
+    exclude -> directories (or glob patterns) to drop
+    include -> directories (or glob patterns) to keep
+    """
+    def __init__(self,filetype=None,exclude=None,include=None):
+        filetype = _aslist(filetype)
+        self.filetypes = frozenset(filetype) if len(filetype) else None
+        self.exclude = _PathSet(_aslist(exclude))
+        self.include = _PathSet(_aslist(include))
+
+    def __bool__(self):
+        return self.filetypes is not None or bool(self.exclude) or bool(self.include)
+
+    def __call__(self,f):
+        """True if the CommitFile passes the filter"""
+        if self.filetypes is not None and f.filetype not in self.filetypes:
+            return False
+        if self.exclude and self.exclude.contains(f.path):
+            return False
+        if self.include and not self.include.contains(f.path):
+            return False
+        return True
+
+    def prune(self,dirpath):
+        """True if no file beneath the split directory path can pass, so the subtree need not be fetched"""
+        if self.exclude and self.exclude.covers(dirpath):
+            return True
+        if self.include and not self.include.reaches(dirpath):
+            return True
+        return False
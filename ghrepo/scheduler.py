@@ -0,0 +1,166 @@
+import random,threading,time
+from bisect import bisect_left
+from .util import sizestr
+
+__all__ = ["RequestError","RequestStats","RequestScheduler"]
+
+class RequestError(Exception):
+    def __init__(self,url,message,status=None):
+        super().__init__("Error during request to {}: {}".format(url,message))
+        self.url = url
+        self.status = status
+
+
+def ratelimited(status,headers,content):
+    """True if a response (status code, headers, body) was refused by a primary or secondary rate limit"""
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    return headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in headers or b'rate limit' in content
+
+def retry_delay(headers,attempt,backoff):
+    """Seconds to wait before retrying a rate limited response: Retry-After, else until the budget resets, else a jittered backoff"""
+    if 'Retry-After' in headers:
+        delay = float(headers['Retry-After'])
+    elif headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+        delay = int(headers['X-RateLimit-Reset'])+1-time.time()
+    else:
+        delay = backoff*(2**attempt)
+    return max(delay,0)*(1+random.random()*0.25)
+
+
+class RequestStats():
+    """Thread safe request counters & latency histogram"""
+    buckets = (0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.bytes = 0
+        self.throttled = 0.0
+        self.latency = [0]*(len(self.buckets)+1)
+
+    def record(self,latency,nbytes=0):
+        with self._lock:
+            self.requests += 1
+            self.bytes += nbytes
+            self.latency[bisect_left(self.buckets,latency)] += 1
+
+    def count(self,**counters):
+        """Increments the named counters (retries, cache_hits, bytes, throttled)"""
+        with self._lock:
+            for k,v in counters.items():
+                setattr(self,k,getattr(self,k)+v)
+
+    def __str__(self):
+        lines = [
+            "requests:   {} ({} retried)".format(self.requests,self.retries),
+            "cache hits: {}".format(self.cache_hits),
+            "received:   {}".format(sizestr(self.bytes)),
+            "throttled:  {:.1f}s".format(self.throttled),
+            "latency:",
+        ]
+        labels = ["<{:g}ms".format(b*1000) for b in self.buckets]+[">{:g}ms".format(self.buckets[-1]*1000)]
+        width = max(self.latency) or 1
+        for label,n in zip(labels,self.latency):
+            if n > 0:
+                lines.append("  {:>8} | {:<30} {}".format(label,"#"*max(1,n*30//width),n))
+        return "\n".join(lines)
+
+
+class RequestScheduler():
+    """
+    Shared http transport for GHSession. Holds a pooled keep-alive requests.Session, caps the number of
+    requests in flight, tracks the api rate limit budget & pauses all workers until it resets once it
+    is exhausted, and retries rate limited (403/429) responses with jittered exponential backoff
+    """
+    def __init__(self,workers=4,pool_size=10,retries=3,backoff=0.5):
+        """
+        workers -> max number of requests in flight
+        pool_size -> max number of keep-alive connections held open per host
+        retries -> number of retries for connection errors, 5xx & rate limited responses
+        backoff -> exponential backoff factor (seconds) between retries
+        """
+        # requests is imported here, so RequestError & RequestStats stay cheap to import
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.workers = max(workers,1)
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = RequestStats()
+        self.remaining = None
+        self.reset = None
+        self._pause = 0.0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._errors = requests.exceptions.RequestException
+        self.http = requests.Session()
+        retry = Retry(total=retries,backoff_factor=backoff,status_forcelist=(500,502,503,504),raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4,pool_maxsize=max(pool_size,self.workers),max_retries=retry)
+        self.http.mount('https://',adapter)
+        self.http.mount('http://',adapter)
+
+    def close(self):
+        self.http.close()
+
+    def _wait(self):
+        # block while the budget is exhausted or a secondary rate limit pause is in effect
+        while True:
+            with self._lock:
+                now = time.time()
+                until = self._pause
+                if self.remaining == 0 and self.reset is not None:
+                    until = max(until,self.reset+1)
+            if until <= now:
+                return
+            self.stats.count(throttled=until-now)
+            time.sleep(until-now)
+
+    def _update(self,r):
+        remaining,reset = r.headers.get('X-RateLimit-Remaining'),r.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self.remaining,self.reset = int(remaining),int(reset)
+
+    def _ratelimited(self,r):
+        # only a refused response's body is read, a streamed body is left unconsumed
+        return r.status_code in (403,429) and ratelimited(r.status_code,r.headers,r.content)
+
+    def _backoff(self,r,attempt):
+        # pause every worker until the retry delay has passed
+        delay = retry_delay(r.headers,attempt,self.backoff)
+        with self._lock:
+            self._pause = max(self._pause,time.time()+delay)
+
+    def get(self,url,stream=False,**kwargs):
+        """Issues a GET request & returns the response, which the caller must close"""
+        return self.request('GET',url,stream,**kwargs)
+
+    def post(self,url,**kwargs):
+        return self.request('POST',url,**kwargs)
+
+    def request(self,method,url,stream=False,**kwargs):
+        for attempt in range(self.retries+1):
+            with self._slots:
+                self._wait()
+                t0 = time.perf_counter()
+                try:
+                    r = self.http.request(method,url,stream=stream,**kwargs)
+                    if not stream:
+                        r.content
+                except self._errors as e:
+                    raise RequestError(url,str(e)) from e
+                latency = time.perf_counter()-t0
+            self._update(r)
+            self.stats.record(latency,0 if stream else len(r.content))
+            if attempt < self.retries and self._ratelimited(r):
+                self._backoff(r,attempt)
+                self.stats.count(retries=1)
+                r.close()
+                continue
+            return r
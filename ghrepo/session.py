@@ -1,101 +1,363 @@
 #!/usr/bin/env python
-import pydecorator
-import os,requests
+import hashlib,os,re,shutil,tarfile,threading,time,requests
+from collections import deque
+from concurrent.futures import Future,ThreadPoolExecutor
 from contextlib import closing
-from zipfile import ZipFile
+from urllib.parse import urlencode,urlparse,parse_qs
 from .tree import *
-from .util import splitpath
+from .scheduler import RequestScheduler,RequestError
+from .pathfilter import PathFilter
+from .util import splitpath,iso_epoch
 
 class TruncatedError(Exception):
     pass
 
+_isobjsha = re.compile('[0-9a-f]{40}$').match
 
+# ----------- Archive Streaming ----------- #
 
-class GHSession():
-    def __init__(self,username,password,repository):
+_BUFSIZE = 2**20
+# block size of tarfile's gzip stream, which slices its buffer on every header read: larger blocks are copied over & over
+_TARBUFSIZE = 2**14
+_EXTRACTARGS = {'filter':'data'} if hasattr(tarfile,'data_filter') else {}
+# members the data filter refuses (eg symlinks to absolute paths or outside the archive), () without the filter
+_FILTERERRORS = (tarfile.FilterError,) if hasattr(tarfile,'FilterError') else ()
+
+def _archivepath(name):
+    """Strips the root directory from an archive member path, None if it is the root or escapes it"""
+    parts = name.split('/')[1:]
+    if not len(parts) or not any(parts) or '..' in parts or name.startswith('/'):
+        return None
+    return '/'.join(parts)
+
+def _blobsha(data):
+    """Git blob sha of data"""
+    return hashlib.sha1(b"blob %d\0"%len(data)+data).hexdigest()
+
+def _extracttar(tar,topath):
+    """
+    Extracts the members of an open tarfile into topath, stripping the archive's '{owner}-{repo}-{sha}/' root directory.
+    Members the data filter refuses, such as symlinks escaping topath, are skipped like BlobStore.materialize skips them.
+    Once a link has been extracted, members whose directory resolves outside topath are skipped as well
+    """
+    root = None
+    for member in tar:
+        member.name = _archivepath(member.name)
+        if member.islnk():
+            member.linkname = _archivepath(member.linkname)
+        if member.name is None or (member.islnk() and member.linkname is None):
+            continue
+        path = os.path.join(topath,member.name)
+        # without links every path stays in topath, as _archivepath drops '..'. a link (unfiltered before the data
+        # filter, or differing only in case from a directory) could redirect later writes, so they are resolved
+        if root is not None and os.path.commonpath([os.path.realpath(os.path.dirname(path)),root]) != root:
+            continue
+        # plain files & directories are written directly, running them through the filter costs more than the write
+        if member.isdir():
+            os.makedirs(path,exist_ok=True)
+            continue
+        if member.isreg():
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            with open(path,'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member),f,_BUFSIZE)
+            if member.mode & 0o100:
+                os.chmod(path,0o755)
+            continue
+        try:
+            tar.extract(member,topath,**_EXTRACTARGS)
+        except _FILTERERRORS:
+            continue
+        if member.issym() or member.islnk():
+            root = os.path.realpath(topath)
+
+class _CountingReader():
+    """Read-only file wrapper that tallies bytes received in the session stats & reports them to progress"""
+    def __init__(self,raw,stats,progress=None):
+        self.raw = raw
+        self.stats = stats
+        self.progress = progress
+
+    def read(self,n=-1):
+        data = self.raw.read(n)
+        self.stats.count(bytes=len(data))
+        if self.progress is not None:
+            self.progress(len(data))
+        return data
+
+# ----------- GraphQL ----------- #
+
+_HISTORY_QUERY = """
+query($owner:String!,$name:String!,$n:Int!,$cursor:String,$since:GitTimestamp,$until:GitTimestamp,$path:String,$author:CommitAuthor) {
+  repository(owner:$owner,name:$name) {
+    defaultBranchRef {
+      target {
+        ... on Commit {
+          history(first:$n,after:$cursor,since:$since,until:$until,path:$path,author:$author) {
+            pageInfo { hasNextPage endCursor }
+            nodes { oid message committedDate additions deletions tree { oid } parents(first:100) { nodes { oid } } }
+          }
+        }
+      }
+    }
+  }
+}"""
+
+_USERID_QUERY = "query($login:String!) { user(login:$login) { id } }"
+
+# ----------- Shared Session Logic ----------- #
+
+class _HistorySync():
+    """
+    Incremental sync of a commit listing against a stored history. Listed commits are fed newest first until
+    a stored commit is reached and every parent of the new commits is known
+    """
+    def __init__(self,history):
+        self.history = history
+        self.known = {c['hash']:c for c in history}
+        self.newshas,self.roots,self.missing,self.knownparents = set(),set(),set(),set()
+
+    @property
+    def done(self):
+        return len(self.roots) > 0 and not len(self.missing)
+
+    def feed(self,sha,record):
+        """Takes a listed commit sha & a callable building its record, returns the record if the commit is new"""
+        self.missing.discard(sha)
+        if sha in self.known:
+            self.roots.add(sha)
+            return None
+        c = record()
+        self.newshas.add(sha)
+        self.missing.update(p for p in c['parents'] if p not in self.known and p not in self.newshas)
+        self.knownparents.update(p for p in c['parents'] if p in self.known)
+        return c
+
+    def tail(self):
+        """Stored commits still reachable from the listing (history may have been rewritten)"""
+        stack,reachable = [*self.roots,*self.knownparents],set()
+        while len(stack):
+            sha = stack.pop()
+            if sha not in reachable and sha in self.known:
+                reachable.add(sha)
+                stack.extend(self.known[sha]['parents'])
+        return [c for c in self.history if c['hash'] in reachable]
+
+
+class GHSessionBase():
+    """Url building, response parsing & tree assembly shared by GHSession and AsyncGHSession"""
+    api = "https://api.github.com"
+    web = "https://github.com"
+
+    def __init__(self,username,password,repository,cache=None,token=None):
+        """
+        repository -> repository name owned by username, or 'owner/name'
+        token -> optional access token, sent as an Authorization header instead of the username & password
+        """
+        owner,_,name = repository.rpartition('/')
         self.user = username
         self.pw = password
-        self.repo = repository
+        self.token = token
+        self.owner = owner or username
+        self.repo = name
+        self.cache = cache
+
+    @property
+    def fullname(self):
+        return "{}/{}".format(self.owner,self.repo)
 
     @property
     def auth(self):
-        return (self.user,self.pw)
+        return None if self.token else (self.user,self.pw)
 
-    def _getjson(self,url):
-        try:
-            with closing(requests.get(url,auth=self.auth)) as r:
-                return r.json()
-        except requests.exceptions.RequestException as e:
-            print('Error during requests to  {}: {}'.format(url, str(e)))
+    def _headers(self,headers=None):
+        """Request headers, with the Authorization header of a token session"""
+        if self.token:
+            return {'Authorization':"token {}".format(self.token),**(headers or {})}
+        return headers or {}
 
+    def _apiurl(self,endpoint):
+        return "{}/repos/{}/{}/{}".format(self.api,self.owner,self.repo,endpoint)
 
-    def commitinfo(self,chash):
-        url = "https://api.github.com/repos/{}/{}/git/commits/{}".format(self.user,self.repo,chash)
-        json = self._getjson(url)
+    def _pageurl(self,endpoint,query=None,per_page=100):
+        """Returns a function mapping a page number to its url"""
+        params = urlencode({**(query or {}),'per_page':per_page}).replace('{','{{').replace('}','}}')
+        return self._apiurl("{}?{}&page={{}}".format(endpoint,params)).format
+
+    @staticmethod
+    def _lastpage(url):
+        return int(parse_qs(urlparse(str(url)).query)['page'][0])
+
+    def _cachekey(self,kind,sha):
+        """Cache key of an immutable object, None if it cannot be cached"""
+        if self.cache is None or not _isobjsha(sha):
+            return None
+        return "{}:{}".format(kind,sha)
+
+    def _cacheobject(self,key,json):
+        if json.get('truncated') is True:
+            # a truncated tree listing is only ever refetched piecewise, its entries are not worth the cache space
+            self.cache.put(key,{'truncated':True})
+            return
+        for f in json.get('files',[]):
+            f.pop('patch',None)
+        self.cache.put(key,json)
+
+    @property
+    def _historykey(self):
+        return "history:{}".format(self.fullname)
+
+    @staticmethod
+    def _commitsquery(since=None,until=None,path=None,author=None):
+        query = {k:v for k,v in (('since',since),('until',until),('path',path),('author',author)) if v is not None}
+        for k in ('since','until'):
+            if type(query.get(k)) in (int,float):
+                query[k] = time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(query[k]))
+        return query
+
+    @property
+    def _graphqlurl(self):
+        # github enterprise serves graphql at /api/graphql beside the rest api at /api/v3
+        return re.sub('/v3$','',self.api)+"/graphql"
+
+    def _historyrecord(self,node):
+        """Normalizes a GraphQL history node into a commit record with the 'additions' & 'deletions' of commitfiles info"""
+        return {
+            "repo":self.repo,
+            "hash":node['oid'],
+            "thash":node['tree']['oid'],
+            "date":node['committedDate'],
+            "time":iso_epoch(node['committedDate']),
+            "message":node['message'],
+            "parents":[p['oid'] for p in node['parents']['nodes']],
+            "additions":node['additions'],
+            "deletions":node['deletions'],
+        }
+
+    def _gitcommitrecord(self,json):
         return {
             "repo":self.repo,
             "hash":json['sha'],
             "thash":json["tree"]["sha"],
             "date":json["committer"]["date"],
+            "time":iso_epoch(json["committer"]["date"]),
             "message":json["message"],
+            "parents":[p['sha'] for p in json['parents']],
         }
 
-    @pydecorator.list
-    def allcommits(self):
-        commits,page = [],1
-        batchurl = "https://api.github.com/repos/{}/{}/commits?per_page=100&page={}".format(self.user,self.repo,page)
-        batch = self._getjson(batchurl)
-        while len(batch)==100:
-            commits,page = commits+batch,page+1
-            batchurl = "https://api.github.com/repos/{}/{}/commits?per_page=100&page={}".format(self.user,self.repo,page)
-            batch = self._getjson(batchurl)
-        for json in (commits+batch):
-            yield {
-                "repo":self.repo,
-                "hash":json['sha'],
-                "thash":json['commit']['tree']['sha'],
-                "date":json['commit']['committer']['date'],
-                "message":json['commit']['message']
-            }
-
-    def filetree_sha(self,thash):
-        url = "https://api.github.com/repos/{}/{}/git/trees/{}".format(self.user,self.repo,thash)
-        json = self._getjson(url)
-        if json['truncated'] == True:
-            raise TruncatedError("File tree is truncted")
-        for f,sha in [(x['path'],x['sha']) for x in json['tree'] if x['type']!='tree']:
-            yield f,sha
-        for st,sthash in [(x['path'],x['sha']) for x in json['tree'] if x['type']=='tree']:
-            for f,sha in self.filetree_sha(sthash):
-                yield os.path.join(st,f),sha
-
-    def filetree(self,thash):
-        return [f for f,sha in self.filetree_sha(thash)]
+    def _commitrecord(self,json):
+        return {
+            "repo":self.repo,
+            "hash":json['sha'],
+            "thash":json['commit']['tree']['sha'],
+            "date":json['commit']['committer']['date'],
+            "time":iso_epoch(json['commit']['committer']['date']),
+            "message":json['commit']['message'],
+            "parents":[p['sha'] for p in json['parents']],
+        }
 
-    def commitfiles(self,chash):
-        url = "https://api.github.com/repos/{}/{}/commits/{}".format(self.user,self.repo,chash)
-        json = self._getjson(url)
+    def _commitfiles(self,json):
         info = {
             'repo':self.repo,
-            'hash':chash,
+            'hash':json['sha'],
             'thash':json["commit"]['tree']['sha'],
             'date':json["commit"]["committer"]["date"],
+            'time':iso_epoch(json["commit"]["committer"]["date"]),
             'message':json["commit"]["message"],
             'additions':json['stats']['additions'],
-            'deletions':json['stats']['deletions']
+            'deletions':json['stats']['deletions'],
+            'author':(json.get('author') or {}).get('login') or json['commit']['author']['name'],
+            'email':json['commit']['author']['email'],
         }
-        return info,sorted([ChangedCommitFile(x) for x in json['files']])
+        return info,sortfiles(ChangedCommitFile(x) for x in json['files'])
 
+    @staticmethod
+    def _treeentries(prefix,sha,recursive,json,prune=None):
+        """
+        Splits one tree response into ([(path,sha,mode),...] files, [(path,sha,recursive),...] subtrees still to fetch).
+        A truncated recursive response is refetched as a plain listing
+        """
+        if json['truncated'] == True:
+            if not recursive:
+                raise TruncatedError("File tree {} is truncated".format(sha))
+            return [],[(prefix,sha,False)]
+        files,subtrees = [],[]
+        for x in json['tree']:
+            if x['type']!='tree':
+                files.append((os.path.join(prefix,x['path']),x['sha'],x['mode']))
+            elif not recursive:
+                path = os.path.join(prefix,x['path'])
+                if prune is None or not prune(splitpath(path)):
+                    subtrees.append((path,x['sha'],True))
+        return files,subtrees
+
+    @staticmethod
+    def _difftrees(prefix,sha,base,head,prune=None):
+        """
+        Compares one level of two (non recursive) tree responses. Returns ([(status,path,sha,mode),...] changed files,
+        [(path,basesha,headsha),...] subtrees differing on both sides, [(status,path,sha),...] subtrees only on one side).
+        Entries with the same sha & mode on both sides are skipped
+        """
+        if base['truncated'] or head['truncated']:
+            raise TruncatedError("File tree {} is truncated".format(sha))
+        b,h = {x['path']:x for x in base['tree']},{x['path']:x for x in head['tree']}
+        files,subtrees,onesided = [],[],[]
+        for name in sorted(b.keys()|h.keys()):
+            x,y = b.get(name),h.get(name)
+            if x is not None and y is not None and x['sha'] == y['sha'] and x['mode'] == y['mode']:
+                continue
+            path = os.path.join(prefix,name)
+            istree = [e is not None and e['type'] == 'tree' for e in (x,y)]
+            if prune is not None and any(istree) and prune(splitpath(path)):
+                # a pruned directory is dropped from both sides
+                x,y = (None if istree[0] else x),(None if istree[1] else y)
+                if x is None and y is None:
+                    continue
+            if x is not None and y is not None:
+                if x['type'] == y['type'] == 'tree':
+                    subtrees.append((path,x['sha'],y['sha']))
+                    continue
+                if x['type'] != 'tree' and y['type'] != 'tree':
+                    files.append(('modified',path,y['sha'],y['mode']))
+                    continue
+            for status,e in (('removed',x),('added',y)):
+                if e is None:
+                    continue
+                if e['type'] == 'tree':
+                    onesided.append((status,path,e['sha']))
+                else:
+                    files.append((status,path,e['sha'],e['mode']))
+        return files,subtrees,onesided
+
+    @staticmethod
+    def _difffiles(files):
+        """Builds ChangedCommitFiles from (status,path,sha,mode) tuples, pairing removed & added files of equal sha as renames"""
+        removed = {}
+        for status,path,sha,mode in files:
+            if status == 'removed':
+                removed.setdefault(sha,[]).append(path)
+        renamed,changed = set(),[]
+        for status,path,sha,mode in files:
+            prevpath = None
+            if status == 'added' and len(removed.get(sha,())):
+                status,prevpath = 'renamed',removed[sha].pop(0)
+                renamed.add(prevpath)
+            elif status == 'removed':
+                continue
+            changed.append(ChangedCommitFile({'filename':path,'sha':sha,'status':status,'additions':None,'deletions':None,'changes':None,'previous_filename':prevpath}))
+        for status,path,sha,mode in files:
+            if status == 'removed' and path not in renamed:
+                changed.append(ChangedCommitFile({'filename':path,'sha':sha,'status':status,'additions':None,'deletions':None,'changes':None}))
+        return changed
 
     @staticmethod
     def _merge_filetree(commits,filetree):
         i1,i2,n1,n2 = 0,0,len(commits),len(filetree)
+        k1,k2 = [f.sortkey for f in commits],[f.sortkey for f in filetree]
         while i1<n1 and i2<n2:
-            z = commits[i1].cmp(filetree[i2])
-            if z < 0:
+            if k1[i1] < k2[i2]:
                 yield commits[i1]
                 i1 = i1+1
-            elif z > 0:
+            elif k1[i1] > k2[i2]:
                 yield filetree[i2]
                 i2 = i2+1
             else:
@@ -109,49 +371,434 @@ class GHSession():
             yield filetree[i2]
             i2 = i2+1
 
+    def _committree(self,json,filetree,pathfilter):
+        """Assembles a CommitTree from a commit response & its (path,sha) file tree"""
+        commit_files = sortfiles(ChangedCommitFile(x) for x in json['files'])
+        files = (CommitFile(*x) for x in filetree)
+        file_tree = sortfiles(f for f in files if pathfilter(f)) if pathfilter else sortfiles(files)
+        stats = json['stats']
+        return CommitTree([*self._merge_filetree(commit_files,file_tree)],self.repo,json['sha'],json["commit"]["committer"]["date"],json["commit"]["message"],stats['additions'],stats['deletions'])
+
+
+class GHSession(GHSessionBase):
+    # missing blobs beyond which export_commit seeds its blob store from the commit's tarball
+    archive_threshold = 50
+
+    def __init__(self,username,password,repository,workers=4,pool_size=10,retries=3,backoff=0.5,cache=None,scheduler=None,token=None):
+        """
+        token -> optional access token, used instead of the username & password
+        cache -> optional ObjectCache serving commit & tree json by object sha
+        scheduler -> optional RequestScheduler to share, otherwise one is created from the arguments below
+        workers -> max number of api requests issued concurrently
+        pool_size -> max number of keep-alive connections held open per host
+        retries -> number of retries for connection errors, 5xx & rate limited responses
+        backoff -> exponential backoff factor (seconds) between retries
+        """
+        super().__init__(username,password,repository,cache,token)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._ownscheduler = scheduler is None
+        self.scheduler = RequestScheduler(workers,pool_size,retries,backoff) if scheduler is None else scheduler
+        self.workers = self.scheduler.workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        """Shuts down the worker pool & closes pooled connections of a scheduler the session created"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._ownscheduler:
+            self.scheduler.close()
+
+    @property
+    def stats(self):
+        return self.scheduler.stats
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _imap(self,fn,items):
+        """Ordered map of fn over items on the worker pool, with a bounded number of calls in flight"""
+        pending = deque()
+        for x in items:
+            pending.append(self.pool.submit(fn,x))
+            if len(pending) >= 2*self.workers:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
+
+    def _get(self,url,conditional=False):
+        """
+        Returns (json,links) where links is the parsed 'Link' header.
+        conditional -> revalidate a stored response with If-None-Match / If-Modified-Since, a 304 is served from the cache
+        """
+        stored,headers = None,{}
+        if conditional and self.cache is not None:
+            stored = self.cache.getresponse(url)
+            if stored is not None:
+                etag,modified,_ = stored
+                if etag: headers['If-None-Match'] = etag
+                if modified: headers['If-Modified-Since'] = modified
+        with closing(self.scheduler.get(url,auth=self.auth,headers=self._headers(headers))) as r:
+            if stored is not None and r.status_code == 304:
+                self.stats.count(cache_hits=1)
+                return tuple(stored[2])
+            if r.status_code >= 400:
+                raise RequestError(url,self._errormessage(r),r.status_code)
+            json = r.json()
+            if conditional and self.cache is not None and ('ETag' in r.headers or 'Last-Modified' in r.headers):
+                self.cache.putresponse(url,r.headers.get('ETag'),r.headers.get('Last-Modified'),[json,r.links])
+            return json,r.links
+
+    @staticmethod
+    def _errormessage(r):
+        try:
+            return "{} {}".format(r.status_code,r.json()['message'])
+        except (ValueError,KeyError,TypeError):
+            return "{} {}".format(r.status_code,r.reason)
+
+    def _getjson(self,url):
+        return self._get(url)[0]
+
+    def _getobject(self,kind,sha,url):
+        """Fetches json for an immutable object, served from the cache when sha is a full object hash"""
+        key = self._cachekey(kind,sha)
+        if key is None:
+            return self._getjson(url)
+        json = self.cache.get(key)
+        if json is not None:
+            self.stats.count(cache_hits=1)
+            return json
+        json = self._getjson(url)
+        self._cacheobject(key,json)
+        return json
+
+    def _pages(self,endpoint,query=None,per_page=100,conditional=False):
+        """
+        Yields each page of a paginated endpoint in order, fetching pages concurrently once the last page is known.
+        query -> optional dict of additional query parameters
+        conditional -> fetch pages one at a time with conditional requests, for callers that expect to stop early
+        """
+        pageurl = self._pageurl(endpoint,query,per_page)
+        batch,links = self._get(pageurl(1),conditional)
+        yield batch
+        if 'last' in links and not conditional:
+            last = self._lastpage(links['last']['url'])
+            yield from self._imap(self._getjson,[pageurl(p) for p in range(2,last+1)])
+            return
+        # no Link header -> probe pages one at a time
+        page = 1
+        while len(batch)==per_page:
+            page = page+1
+            batch = self._get(pageurl(page),conditional)[0]
+            yield batch
+
+
+    def commitinfo(self,chash):
+        url = self._apiurl("git/commits/{}".format(chash))
+        return self._gitcommitrecord(self._getobject('gitcommit',chash,url))
+
+    def iter_commits(self,since=None,until=None,path=None,author=None):
+        """
+        Lazily yields commit records newest first, as their pages arrive.
+        since,until -> only commits in this range (epoch seconds or iso8601 strings)
+        path -> only commits touching this path
+        author -> only commits by this login or email
+        Filters are sent with the query, so only matching history is paged. Unfiltered iteration
+        with a cache is synced incrementally against the previously stored history
+        """
+        query = self._commitsquery(since,until,path,author)
+        if len(query) or self.cache is None:
+            for batch in self._pages("commits",query):
+                for json in batch:
+                    yield self._commitrecord(json)
+            return
+        history = self.cache.get(self._historykey)
+        commits = []
+        for c in (self._listcommits() if history is None else self._synccommits(history)):
+            commits.append(c)
+            yield c
+        self.cache.put(self._historykey,commits)
+
+    def allcommits(self,**filters):
+        """Returns all commits in the repository, filters are those of iter_commits"""
+        return [*self.iter_commits(**filters)]
+
+    def graphql(self,query,variables=None):
+        """Posts a GraphQL query & returns its data, errors reported in the response are raised as a RequestError"""
+        url = self._graphqlurl
+        with closing(self.scheduler.post(url,auth=self.auth,headers=self._headers(),json={'query':query,'variables':variables or {}})) as r:
+            if r.status_code >= 400:
+                raise RequestError(url,self._errormessage(r),r.status_code)
+            json = r.json()
+        if json.get('errors'):
+            raise RequestError(url,"; ".join(e.get('message','unknown error') for e in json['errors']))
+        return json['data']
+
+    def iter_history(self,since=None,until=None,path=None,author=None,per_page=100):
+        """
+        Lazily yields commit records newest first with their 'additions' & 'deletions', paged through the GraphQL api.
+        A history with stats costs one request per per_page (max 100) commits, instead of a commitfiles call per commit.
+        Filters are those of iter_commits
+        """
+        query = self._commitsquery(since,until,path,author)
+        variables = {'owner':self.owner,'name':self.repo,'n':per_page,**query}
+        if author is not None:
+            variables['author'] = {'emails':[author]} if '@' in author else {'id':self.graphql(_USERID_QUERY,{'login':author})['user']['id']}
+        while True:
+            ref = self.graphql(_HISTORY_QUERY,variables)['repository']['defaultBranchRef']
+            if ref is None:
+                # empty repository
+                return
+            history = ref['target']['history']
+            for node in history['nodes']:
+                yield self._historyrecord(node)
+            if not history['pageInfo']['hasNextPage']:
+                return
+            variables['cursor'] = history['pageInfo']['endCursor']
+
+    def _listcommits(self):
+        for batch in self._pages("commits"):
+            for json in batch:
+                yield self._commitrecord(json)
+
+    def _synccommits(self,history):
+        sync = _HistorySync(history)
+        yield from self._newcommits(sync)
+        yield from sync.tail()
+
+    def _newcommits(self,sync):
+        pages = self._pages("commits",conditional=True)
+        for batch in pages:
+            for json in batch:
+                c = sync.feed(json['sha'],lambda:self._commitrecord(json))
+                if c is not None:
+                    yield c
+                if sync.done:
+                    break
+            else:
+                continue
+            pages.close()
+            break
+
+    def new_commits(self,history):
+        """
+        Syncs against a stored history (records with 'hash' & 'parents'), paging only until the listing connects to it.
+        Returns (new,reachable) -> records of the new commits newest first, hashes of the stored commits still in the history
+        """
+        sync = _HistorySync(history)
+        new = [*self._newcommits(sync)]
+        return new,[c['hash'] for c in sync.tail()]
+
+    def _treejson(self,thash,recursive=False):
+        url = self._apiurl("git/trees/{}{}".format(thash,"?recursive=1" if recursive else ""))
+        return self._getobject('rtree' if recursive else 'tree',thash,url)
+
+    def filetree_entries(self,thash,prune=None):
+        """
+        Yields (path,sha,mode) for each file in a tree. The whole tree is requested in a single recursive call,
+        subtrees of a truncated response are fetched concurrently (each again recursively first).
+        prune -> optional callable taking a split directory path, subtrees it returns True for are not fetched
+        """
+        pending = [('',thash,True)]
+        while len(pending):
+            subtrees = []
+            for (prefix,sha,recursive),json in zip(pending,self._imap(lambda x:self._treejson(x[1],x[2]),pending)):
+                files,more = self._treeentries(prefix,sha,recursive,json,prune)
+                yield from files
+                subtrees.extend(more)
+            pending = subtrees
+
+    def filetree_sha(self,thash,prune=None):
+        """Yields (path,sha) for each file in a tree"""
+        for path,sha,mode in self.filetree_entries(thash,prune):
+            yield path,sha
+
+    def filetree(self,thash):
+        return [f for f,sha in self.filetree_sha(thash)]
+
+    def commitfiles(self,chash):
+        url = self._apiurl("commits/{}".format(chash))
+        return self._commitfiles(self._getobject('commit',chash,url))
+
+    def iter_commitfiles(self,hashes):
+        """Yields commitfiles of each commit hash in order, fetching them concurrently"""
+        yield from self._imap(self.commitfiles,hashes)
+
+    def _committhash(self,ref):
+        """Tree sha of a commit sha or ref (branch, tag, HEAD)"""
+        if _isobjsha(ref):
+            return self.commitinfo(ref)['thash']
+        return self._getobject('commit',ref,self._apiurl("commits/{}".format(ref)))['commit']['tree']['sha']
+
+    def diff_trees(self,base,head,prune=None):
+        """
+        Yields (status,path,sha,mode) for each file that differs between trees base & head. The trees are walked one
+        level at a time from their roots with plain listings, descending only into subtrees whose shas differ, so
+        identical subtrees are never fetched & the cost scales with the size of the change rather than the size of
+        the tree. The differing pairs of each level are fetched concurrently. Subtrees only on one side are listed
+        with filetree_entries.
+        prune -> optional callable taking a split directory path, subtrees it returns True for are not compared
+        """
+        pending,onesided = [('',base,head)] if base != head else [],[]
+        while len(pending):
+            subtrees = []
+            trees = self._imap(self._treejson,[sha for prefix,b,h in pending for sha in (b,h)])
+            for prefix,b,h in pending:
+                bjson,hjson = next(trees),next(trees)
+                root = splitpath(prefix)
+                subprune = None if prune is None else lambda dirpath,root=root:prune(root+dirpath)
+                files,more,other = self._difftrees('',h,bjson,hjson,subprune)
+                subtrees.extend((os.path.join(prefix,path),b,h) for path,b,h in more)
+                onesided.extend((status,os.path.join(prefix,path),sha) for status,path,sha in other)
+                for status,path,sha,mode in files:
+                    yield status,os.path.join(prefix,path),sha,mode
+            pending = subtrees
+        for status,prefix,sha in onesided:
+            root = splitpath(prefix)
+            subprune = None if prune is None else lambda dirpath:prune(root+dirpath)
+            for path,fsha,mode in self.filetree_entries(sha,subprune):
+                yield status,os.path.join(prefix,path),fsha,mode
+
+    def diff(self,base,head,filetype=None,exclude=None,include=None):
+        """
+        Returns the sorted ChangedCommitFiles between commits (or refs) base & head. Their additions & deletions
+        are None, and files moved without changes are reported as renamed.
+        filetype,exclude,include -> file filters, as for commit_tree
+        """
+        pathfilter = PathFilter(filetype,exclude,include)
+        files = self._difffiles([*self.diff_trees(self._committhash(base),self._committhash(head),pathfilter.prune if pathfilter else None)])
+        return sortfiles(f for f in files if pathfilter(f)) if pathfilter else sortfiles(files)
+
     def commit_tree(self,sha,filetype=None,exclude=None,include=None):
         """
         filetype -> filetypes to use in file tree
-        exclude -> paths to exclude from file tree
+        exclude -> paths (or glob patterns) to exclude from file tree
+        include -> paths (or glob patterns) to include in file tree
+        Subtrees the filter rules out are not fetched when the tree has to be requested piecewise
         """
-        url = "https://api.github.com/repos/{}/{}/commits/{}".format(self.user,self.repo,sha)
-        json = self._getjson(url)
-        treehash = json["commit"]['tree']['sha']
-        date = json["commit"]["committer"]["date"]
-        message = json["commit"]["message"]
-        stats = json['stats']
-        commit_files = sorted([ChangedCommitFile(x) for x in json['files']])
-        file_tree = sorted([CommitFile(*x) for x in self.filetree_sha(treehash)])
-        if filetype != None:
-            if type(filetype) == str: filetype = [filetype]
-            file_tree = [f for f in file_tree if f.filetype in filetype]
-        if exclude != None:
-            if type(exclude) == str: exclude = [exclude]
-            exclude = [splitpath(p) for p in exclude]
-            file_tree = [f for f in file_tree if not any(f.inpath(x) for x in exclude)]
-        if include != None:
-            if type(include) == str: include = [include]
-            include = [splitpath(p) for p in include]
-            file_tree = [f for f in file_tree if any(f.inpath(x) for x in include)]
-        return CommitTree([*self._merge_filetree(commit_files,file_tree)],self.repo,sha,date,message,stats['additions'],stats['deletions'])
-
-        return CommitTree([*self._merge_filetree(commit_files,file_tree)],self.repo,sha,date,message,stats['additions'],stats['deletions'])
-
-    def download_commit(self,chash,topath):
-        zipurl = "https://github.com/{}/{}/archive/{}.zip".format(self.user,self.repo,chash)
-        dirpath = os.path.dirname(topath)
-        zippath = os.path.join(dirpath,"{}-{}".format(self.repo,chash))
-        # Download
+        url = self._apiurl("commits/{}".format(sha))
+        json = self._getobject('commit',sha,url)
+        pathfilter = PathFilter(filetype,exclude,include)
+        filetree = self.filetree_sha(json["commit"]['tree']['sha'],pathfilter.prune if pathfilter else None)
+        return self._committree(json,filetree,pathfilter)
+
+    def download_commit(self,chash,topath,progress=None):
+        """
+        Streams the commit's tarball, extracting entries straight into topath as they arrive.
+        progress -> optional callable receiving the number of bytes read from each chunk
+        """
+        url = self._apiurl("tarball/{}".format(chash))
+        partpath = topath+".part"
+        with closing(self.scheduler.get(url,stream=True,auth=self.auth,headers=self._headers())) as r:
+            if r.status_code >= 400:
+                raise RequestError(url,self._errormessage(r),r.status_code)
+            r.raw.decode_content = True
+            try:
+                with tarfile.open(fileobj=_CountingReader(r.raw,self.stats,progress),mode='r|gz',bufsize=_TARBUFSIZE,copybufsize=_BUFSIZE) as tar:
+                    _extracttar(tar,partpath)
+            except BaseException as e:
+                shutil.rmtree(partpath,ignore_errors=True)
+                if isinstance(e,requests.exceptions.RequestException):
+                    raise RequestError(url,str(e)) from e
+                raise
+        os.rename(partpath,topath)
+
+    def blob(self,sha):
+        """Returns the raw content of a blob"""
+        url = self._apiurl("git/blobs/{}".format(sha))
+        with closing(self.scheduler.get(url,auth=self.auth,headers=self._headers({'Accept':'application/vnd.github.raw'}))) as r:
+            if r.status_code >= 400:
+                raise RequestError(url,self._errormessage(r),r.status_code)
+            return r.content
+
+    def _seedstore(self,chash,entries,keys,store,progress=None):
+        """
+        Streams the commit's tarball into store, keeping the files whose (sha,mode) in the tree listing is one of keys.
+        Archived files can differ from their blob (export-subst, eol conversion), those are left for a blob fetch
+        entries -> {path:(sha,mode)} of the commit's tree listing
+        """
+        url = self._apiurl("tarball/{}".format(chash))
+        with closing(self.scheduler.get(url,stream=True,auth=self.auth,headers=self._headers())) as r:
+            if r.status_code >= 400:
+                raise RequestError(url,self._errormessage(r),r.status_code)
+            r.raw.decode_content = True
+            try:
+                with tarfile.open(fileobj=_CountingReader(r.raw,self.stats,progress),mode='r|gz',bufsize=_TARBUFSIZE) as tar:
+                    for member in tar:
+                        key = entries.get(_archivepath(member.name))
+                        if key is None or key not in keys or store.has(*key):
+                            continue
+                        if member.issym():
+                            # a symlink blob holds its target
+                            data = member.linkname.encode()
+                        elif member.isfile():
+                            data = tar.extractfile(member).read()
+                        else:
+                            continue
+                        if _blobsha(data) == key[0]:
+                            store.put(*key,data)
+            except requests.exceptions.RequestException as e:
+                raise RequestError(url,str(e)) from e
+
+    def export_commit(self,thash,topath,store,progress=None,chash=None):
+        """
+        Materializes the tree thash into topath from a BlobStore, fetching only blobs missing from the store.
+        Unchanged files are hard linked to the store, so consecutive snapshots share their storage.
+        progress -> optional callable receiving the number of bytes of each fetched blob (or tarball chunk)
+        chash -> the commit of thash. When more than archive_threshold blobs are missing (the first snapshot of a
+            repository), the store is seeded from its tarball in one request instead of a request per blob
+        """
+        entries = [(path,sha,mode) for path,sha,mode in self.filetree_entries(thash) if mode != '160000']
+        # claim missing blobs, or wait on blobs another export is already fetching
+        claimed,waiting = [],[]
+        with self._lock:
+            for key in {(sha,mode) for path,sha,mode in entries if not store.has(sha,mode)}:
+                if key in self._inflight:
+                    waiting.append(self._inflight[key])
+                else:
+                    self._inflight[key] = Future()
+                    claimed.append(key)
+        try:
+            fetch = claimed
+            if chash is not None and len(claimed) > self.archive_threshold:
+                self._seedstore(chash,{path:(sha,mode) for path,sha,mode in entries},set(claimed),store,progress)
+                # blobs the tarball did not hold are fetched one by one
+                fetch = [key for key in claimed if not store.has(*key)]
+                with self._lock:
+                    for key in claimed:
+                        if store.has(*key):
+                            self._inflight.pop(key).set_result(None)
+            for key,data in zip(fetch,self._imap(lambda x:self.blob(x[0]),fetch)):
+                store.put(*key,data)
+                if progress is not None:
+                    progress(len(data))
+                with self._lock:
+                    self._inflight.pop(key).set_result(None)
+        except BaseException as e:
+            with self._lock:
+                for key in claimed:
+                    if key in self._inflight:
+                        self._inflight.pop(key).set_exception(e)
+            raise
+        for f in waiting:
+            f.result()
+        partpath = topath+".part"
         try:
-            with closing(requests.get(zipurl,stream=True,auth=self.auth)) as r,open(zippath+".zip",'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    f.write(chunk)
-        except requests.exceptions.RequestException as e:
-            print('Error during requests to {0} : {1}'.format(zipurl, str(e)))
-        # Extract
-        with ZipFile(zippath+".zip", 'r') as z:
-            z.extractall(dirpath)
-        # Remove Zipfile
-        os.remove(zippath+".zip")
-        # Rename
-        os.rename(zippath,topath)
+            os.makedirs(partpath)
+            for path,sha,mode in entries:
+                store.materialize(sha,mode,partpath,path)
+        except BaseException:
+            shutil.rmtree(partpath,ignore_errors=True)
+            raise
+        os.rename(partpath,topath)
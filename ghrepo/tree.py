@@ -1,12 +1,29 @@
-import os
-from .util import iter_reduce,cli_color,splitpath
+import os,sys
+from functools import lru_cache
+from operator import attrgetter
+from .util import cli_color,splitpath
 
-__all__ = ["CommitFile","ChangedCommitFile","CommitTree"]
+__all__ = ["CommitFile","ChangedCommitFile","CommitTree","sortfiles","itertree"]
+
+@lru_cache(maxsize=2**14)
+def _splitdir(dirname):
+    # directory components are interned, so files share a single copy of each name
+    return tuple(sys.intern(d) for d in splitpath(dirname))
+
+def _splitfile(path):
+    dirname,_,filename = path.rpartition('/')
+    return _splitdir(dirname)+(filename,)
+
+def sortfiles(files):
+    """Sorts CommitFile objects by their precomputed sort keys"""
+    return sorted(files,key=attrgetter('sortkey'))
 
 class CommitFile():
+    __slots__ = ('sha','path')
+
     def __init__(self,path,sha):
         self.sha = sha
-        self.path = splitpath(path)
+        self.path = _splitfile(path)
 
     def __str__(self):
         return os.path.join(*self.path)
@@ -53,6 +70,18 @@ class CommitFile():
         f1,f2 = p1[-1],p2[-1]
         return 1 if f1 > f2 else -1 if f1 < f2 else 0
 
+    @staticmethod
+    def pathkey(path):
+        """Flat sort key of a split path, (1,dir,...,0,file), which orders files before subdirectories like _cmp_"""
+        key = [1]*(2*len(path))
+        key[1::2] = path
+        key[-2] = 0
+        return tuple(key)
+
+    @property
+    def sortkey(self):
+        return self.pathkey(self.path)
+
     def cmp(self,other):
         # _cmp_ where p1=self & p2=other
         if not isinstance(other,CommitFile):
@@ -63,40 +92,42 @@ class CommitFile():
         # self == other
         if not isinstance(other,CommitFile):
             return False
-        return self._cmp_(self.path,other.path) == 0
+        return self.path == other.path
 
     def __ne__(self,other):
         # self != other
         if not isinstance(other,CommitFile):
             return True
-        return self._cmp_(self.path,other.path) != 0
+        return self.path != other.path
 
     def __lt__(self, other):
         # self  < other
         if not isinstance(other,CommitFile):
             raise ValueError("Cannot compare to object of type {}".format(type(other).__name__))
-        return self._cmp_(self.path,other.path) == -1
+        return self.sortkey < other.sortkey
 
     def __le__(self, other):
         # self <= other
         if not isinstance(other,CommitFile):
             raise ValueError("Cannot compare to object of type {}".format(type(other).__name__))
-        return self._cmp_(self.path,other.path) <= 0
+        return self.sortkey <= other.sortkey
 
     def __gt__(self, other):
         # self > other
         if not isinstance(other,CommitFile):
             raise ValueError("Cannot compare to object of type {}".format(type(other).__name__))
-        return self._cmp_(self.path,other.path) == 1
+        return self.sortkey > other.sortkey
 
     def __ge__(self, other):
         # self >= other
         if not isinstance(other,CommitFile):
             raise ValueError("Cannot compare to object of type {}".format(type(other).__name__))
-        return self._cmp_(self.path,other.path) >= 0
+        return self.sortkey >= other.sortkey
 
 
 def changestr(additions,deletions):
+    if additions is None:
+        return ""
     changes = ((cli_color("+%i"%additions,"32;1"),) if additions>1 else ())+((cli_color("-%i"%deletions,"31;1"),) if deletions>1 else ())
     return " [%s]"%",".join(changes) if len(changes) > 0 else ""
 
@@ -104,14 +135,15 @@ def changestr(additions,deletions):
 
 
 class ChangedCommitFile(CommitFile):
+    __slots__ = ('status','additions','deletions','changes','prevpath')
+
     def __init__(self,json):
         super().__init__(json["filename"],json["sha"])
         self.status = json["status"]
         self.additions = json["additions"]
         self.deletions = json['deletions']
         self.changes = json['changes']
-        if self.status == 'renamed':
-            self.prevpath = json['previous_filename']
+        self.prevpath = json['previous_filename'] if self.status == 'renamed' else None
 
     # cyan = 36
     # yellow = 33
@@ -119,7 +151,10 @@ class ChangedCommitFile(CommitFile):
     # red = 31
     @property
     def treestr(self):
+        # tree diffs carry no line stats (additions is None)
         path = str(self)
+        if self.additions is None and self.status in ("added","removed"):
+            return cli_color(path,32 if self.status == "added" else 31)
         if self.status == "added":
             return "{} [{}]".format(cli_color(path,32),cli_color("+%i"%self.additions,"32;1"))
         if self.status == "removed":
@@ -131,18 +166,41 @@ class ChangedCommitFile(CommitFile):
         raise ValueError("Unknown ChangedCommitFile type {}".format(self.status))
 
 
-def maketree(paths,lvl=0):
-    i,n = 0,len(paths)
-    while i < n and len(paths[i])-lvl == 1:
-        i=i+1
-    if i == n:
-        return ["├── {}".format(f.treestr) for f in paths[:-1]]+["└── {}".format(paths[-1].treestr)]
-    ftree = ["├── {}".format(f.treestr) for f in paths[:i]]
-    groups = [i]+[x for x in range(i+1,n) if paths[x].path[lvl]!=paths[x-1].path[lvl]]
-    for i1,i2 in iter_reduce(groups):
-        ftree += ["├── {}".format(paths[i1].path[lvl])]+["│   {}".format(f) for f in maketree(paths[i1:i2],lvl+1)]
-    i = groups[-1]
-    return ftree + ["└── {}".format(paths[i].path[lvl])]+["    {}".format(f) for f in maketree(paths[i:],lvl+1)]
+def _commondirs(p1,p2):
+    # number of leading directories shared by two split paths
+    i,n = 0,min(len(p1),len(p2))-1
+    while i < n and p1[i] == p2[i]:
+        i = i+1
+    return i
+
+def itertree(files):
+    """Lazily yields the lines of the tree drawing of a sorted list of CommitFiles"""
+    n = len(files)
+    # common[i] -> directories shared by files i & i+1 (-1 past the last file)
+    common = [_commondirs(files[i].path,files[i+1].path) for i in range(n-1)]+[-1]
+    # backward pass: for each directory a file opens, whether it is the last entry of its parent
+    opened,lastdir = [None]*n,[]
+    for i in range(n-1,-1,-1):
+        depth = len(files[i].path)-1
+        lastdir.extend([False]*(depth-len(lastdir)))
+        for d in range(max(common[i],0),depth):
+            lastdir[d] = d > common[i]
+        start = common[i-1] if i > 0 else 0
+        if start < depth:
+            opened[i] = lastdir[start:depth]
+    # forward pass: indent[d] is the line prefix for entries at depth d
+    indent = ['']
+    for i,f in enumerate(files):
+        depth,start = len(f.path)-1,(common[i-1] if i > 0 else 0)
+        del indent[start+1:]
+        if opened[i] is not None:
+            for d,last in enumerate(opened[i],start):
+                yield "{}{}{}".format(indent[d],"└── " if last else "├── ",f.path[d])
+                indent.append(indent[d]+(" \xa0\xa0 " if last else "│\xa0\xa0 "))
+        yield "{}{}{}".format(indent[depth],"├── " if common[i] == depth else "└── ",f.treestr)
+
+def maketree(paths):
+    return [*itertree(paths)]
 
 
 
@@ -161,6 +219,9 @@ class CommitTree():
             return getattr(self,k)
         raise KeyError("CommitTree has no key '{}'".format(k))
 
+    def itertree(self):
+        yield "{} Files{}".format(len(self.files),changestr(self.additions,self.deletions))
+        yield from itertree(self.files)
+
     def tree(self):
-        head = ["{} Files{}".format(len(self.files),changestr(self.additions,self.deletions))]
-        return "\n".join(head+maketree(self.files))
+        return "\n".join(self.itertree())
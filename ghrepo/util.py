@@ -1,23 +1,20 @@
 #!/usr/bin/env python
-import pydecorator,os
-
-def iter_reduce(iterable,init=None):
-    it = iter(iterable)
-    try:
-        v0 = next(it) if init is None else init
-    except StopIteration:
-        return
-    for v1 in it:
-        yield v0,v1
-        v0 = v1
+import os,re,sys,calendar,threading,time
+from functools import lru_cache
+from operator import itemgetter
 
+def sizestr(n):
+    """Formats a number of bytes for display"""
+    for unit in ('B','KiB','MiB','GiB'):
+        if n < 1024 or unit == 'GiB':
+            return "{:.1f} {}".format(n,unit) if unit != 'B' else "{} B".format(n)
+        n = n/1024
 
 def splitpath(path):
     """Splits a path into all its components"""
-    p0,p1,p = (*os.path.split(path),tuple())
-    while p1!='':
-        p0,p1,p = (*os.path.split(p0),(p1,) + p)
-    return p
+    if os.sep != '/':
+        path = path.replace(os.sep,'/')
+    return tuple(p for p in path.split('/') if p != '')
 
 # ================================ [iso-time] ================================ #
 
@@ -27,93 +24,130 @@ def iso_date(iso):
 def iso_time(iso):
     return "{}:{}:{}".format(iso[11:13],iso[14:16],iso[17:19])
 
-def cmp_iso(a,b):
-    """ Compares two iso8601 format dates. returns [0 : a = b], [-1 : a < b], [1 : a > b] """
-    y0,y1 = int(a[:4]),int(b[:4])
-    if y0 != y1: return -1 if y0 < y1 else 1
-    m0,m1 = int(a[5:7]),int(b[5:7])
-    if m0 != m1: return -1 if m0 < m1 else 1
-    d0,d1 = int(a[8:10]),int(b[8:10])
-    if d0 != d1: return -1 if d0 < d1 else 1
-    H0,H1 = int(a[11:13]),int(b[11:13])
-    if H0 != H1: return -1 if H0 < H1 else 1
-    M0,M1 = int(a[14:16]),int(b[14:16])
-    if M0 != M1: return -1 if M0 < M1 else 1
-    S0,S1 = int(a[17:19]),int(b[17:19])
-    return 1 if S0 > S1 else -1 if S0 < S1 else 0
+def iso_epoch(iso):
+    """Converts an iso8601 format date (YYYY-MM-DDTHH:MM:SS, read as UTC) to epoch seconds"""
+    return calendar.timegm((int(iso[:4]),int(iso[5:7]),int(iso[8:10]),int(iso[11:13] or 0),int(iso[14:16] or 0),int(iso[17:19] or 0)))
+
+def isodate(text):
+    """Parses a 'YYYY-MM-DD[THH:MM[:SS]][Z]' argument to epoch seconds"""
+    if not re.match(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2})?)?Z?$',text):
+        raise ValueError("Invalid iso8601 date '{}'".format(text))
+    return iso_epoch(text)
+
+# ================================ [timeline] ================================ #
+
+def sort_commits(commits):
+    """Sorts commit records by their parsed 'time'"""
+    return sorted(commits,key=itemgetter('time'))
+
+def _bisect_time(commits,t,right=False):
+    lo,hi = 0,len(commits)
+    while lo < hi:
+        mid = (lo+hi)//2
+        if commits[mid]['time'] < t or (right and commits[mid]['time'] == t):
+            lo = mid+1
+        else:
+            hi = mid
+    return lo
+
+def commit_range(commits,since=None,until=None,limit=None):
+    """
+    Returns the slice of time sorted commits with since <= time <= until, limited to the most recent
+    limit commits. Bounds are found by binary search over the sorted timeline
+    """
+    lo = 0 if since is None else _bisect_time(commits,since)
+    hi = len(commits) if until is None else _bisect_time(commits,until,right=True)
+    if limit is not None:
+        lo = max(lo,hi-limit)
+    return commits[lo:hi]
+
+# ================================ [commit-format] ================================ #
+
+class CommitFormat():
+    """
+    Format template compiled once into a str.format template & a list of field accessors.
+    Each '%x' code is looked up in codes, a dict mapping code characters to functions of a commit
+    """
+    def __init__(self,fmt,codes):
+        template,fields,used,i = [],[],set(),0
+        j = fmt.find("%")
+        while j >= 0:
+            if j+1 == len(fmt):
+                raise ValueError("Format '{}' ends with an incomplete variable".format(fmt))
+            code = fmt[j+1]
+            if code not in codes:
+                raise ValueError("Unrecognized Format Variable '{}'".format(code))
+            template.append(fmt[i:j].replace("{","{{").replace("}","}}")+"{}")
+            fields.append(codes[code])
+            used.add(code)
+            i = j+2
+            j = fmt.find("%",i)
+        template.append(fmt[i:].replace("{","{{").replace("}","}}"))
+        self.fmt = fmt
+        self.codes = frozenset(used)
+        self._template = "".join(template).format
+        self._fields = fields
+
+    def __call__(self,commit):
+        return self._template(*[f(commit) for f in self._fields])
 
 # ================================ [ls-display] ================================ #
 
-def ls_commit_format_code(code,commit):
+LS_FORMAT_CODES = {
     # Repo
-    if code == "r": return commit['repo']
+    "r":lambda c:c['repo'],
     # Date
-    if code == "d": return iso_date(commit['date'])
+    "d":lambda c:iso_date(c['date']),
     # Time
-    if code == "t": return iso_time(commit['date'])
+    "t":lambda c:iso_time(c['date']),
     # Short Hash
-    if code == "h": return commit['hash'][:8]
+    "h":lambda c:c['hash'][:8],
     # Long Hash
-    if code == "H": return commit['hash']
+    "H":lambda c:c['hash'],
     # First line of message
-    if code == "m": return commit['message'].split("\n")[0]
+    "m":lambda c:c['message'].partition("\n")[0],
     # Full Message Indented
-    if code == "M": return '\n'.join('\t'+x for x in commit['message'].split('\n'))
-    raise IndexError("Unrecognized Format Variable '{}'".format(code))
+    "M":lambda c:"\t"+c['message'].replace("\n","\n\t"),
+    # Lines Added
+    "A":lambda c:c['additions'],
+    # Lines Deleted
+    "D":lambda c:c['deletions'],
+}
+
+@lru_cache(maxsize=32)
+def compile_ls_format(fmt):
+    return CommitFormat(fmt,LS_FORMAT_CODES)
 
-@pydecorator.str
 def ls_commit_format(commit,fmt):
     """Returns a string to display"""
-    i = 0
-    try:
-        j = fmt.index("%",i)
-        while True:
-            if j > i:
-                yield fmt[i:j]
-            yield ls_commit_format_code(fmt[j+1],commit)
-            i = j+2
-            j = fmt.index("%",i)
-    except ValueError:
-        j = len(fmt)
-    finally:
-        if j > i:
-            yield fmt[i:j]
+    return compile_ls_format(fmt)(commit)
 
 
 # ================================ [get-filename] ================================ #
 
-def get_commit_format_code(code,commit):
-    if code == "r": return commit['repo']
-    if code == "d": return iso_date(commit['date'])
-    if code == "t": return iso_time(commit['date']).replace(':','.')
+def _filename_message(commit):
+    # normalize message (make it an acceptable file path)
+    # TODO - Make platform depenedant
+    return commit['message'].partition("\n")[0].replace(":","-").replace("/","-")
+
+GET_FORMAT_CODES = {
+    "r":lambda c:c['repo'],
+    "d":lambda c:iso_date(c['date']),
+    "t":lambda c:iso_time(c['date']).replace(':','.'),
     # Short Hash
-    if code == "h": return commit['hash'][:8]
+    "h":lambda c:c['hash'][:8],
     # Long Hash
-    if code == "H": return commit['hash']
-    if code == "m":
-        # normalize message (make it an acceptable file path)
-        # TODO - Make platform depenedant
-        message = commit['message'].split("\n")[0]
-        return message.replace(":","-").replace("/","-")
-    raise IndexError("Unrecognized Format Variable '{}'".format(code))
-
-@pydecorator.str
+    "H":lambda c:c['hash'],
+    "m":_filename_message,
+}
+
+@lru_cache(maxsize=32)
+def compile_get_format(fmt):
+    return CommitFormat(fmt,GET_FORMAT_CODES)
+
 def get_commit_format(commit,fmt):
     """Returns a string usable as a filename"""
-    i = 0
-    try:
-        j = fmt.index("%",i)
-        while True:
-            if j > i:
-                yield fmt[i:j]
-            yield get_commit_format_code(fmt[j+1],commit)
-            i = j+2
-            j = fmt.index("%",i)
-    except ValueError:
-        j = len(fmt)
-    finally:
-        if j > i:
-            yield fmt[i:j]
+    return compile_get_format(fmt)(commit)
 
 
 
@@ -140,3 +174,40 @@ def cli_color(text,*colors):
 
 def cli_warning(message):
     print("\x1b[31mWarning: {}\x1b[0m".format(message),file=sys.stderr)
+
+class DownloadProgress():
+    """Thread safe aggregate progress line (commits done, bytes received, rate) written to stderr"""
+    def __init__(self,total,interval=0.2):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._start = self._shown = time.monotonic()
+
+    def received(self,n):
+        with self._lock:
+            self.bytes += n
+            now = time.monotonic()
+            if now-self._shown >= self.interval:
+                self._shown = now
+                self._show(now)
+
+    def finished(self,ok=True):
+        with self._lock:
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            self._show(time.monotonic())
+
+    def _show(self,now):
+        rate = self.bytes/max(now-self._start,1e-6)
+        failed = ", {} failed".format(self.failed) if self.failed else ""
+        print("\r\x1b[K[{}/{} commits{}] {} ({}/s)".format(self.done,self.total,failed,sizestr(self.bytes),sizestr(rate)),end='',file=sys.stderr,flush=True)
+
+    def close(self):
+        with self._lock:
+            self._show(time.monotonic())
+            print(file=sys.stderr)
@@ -22,7 +22,8 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: Utilities',
     ],
-    install_requires=['pydecorator'],
+    install_requires=['requests'],
+    extras_require={'async':['aiohttp'],'msgpack':['msgpack']},
     packages=['ghrepo'],
     entry_points={ 
         'console_scripts': [